@@ -24,18 +24,91 @@
 #           "part-failed"       - a part failed
 #           "part-finished"     - a part finished
 #           "progress"          - progress
+#       
+#       The first part reserves room in its onMetaData tag so that, when joining, a keyframe
+#       index (and the correct filesize) can be written in place.
+#       
+#       A clip (from some start time) can be downloaded instead of the whole video;
+#       its timestamps then start from 0.
+#       
+#       Only the audio or only the video may be kept (see #MultiPart_Downloader.save_stream()).
+#       
+#       Instead of a filename, the FLV can also be downloaded into memory (for short videos).
+#       
+#       If a part fails, it is restarted (after a delay) from its last keyframe while the
+#       other parts carry on. The download is only aborted once a part runs out of retries.
+#       
+#       The start & end times negotiated for each part are kept in a journal file
+#       (@filename.journal) so that an interrupted download can be resumed without
+#       negotiating them again. Without the journal (or with a different number of parts),
+#       the part files left behind are resumed where they are and new parts fill the gaps.
+#       
+#       Each part keeps a checksum of the data it writes, which the part is checked against when
+#       it is joined; the SHA-1 of the joined FLV is worked out as it is joined.
+#       #verify_files() checks FLV files (or parts) for corruption.
+#       
+#       The progress of each part is kept on a #ProgressBoard in shared memory, which
+#       "progress" is emitted from at a fixed interval (and which other processes may read).
+#       Other messages from the parts are passed on a #MessageQueue, on which debug and info
+#       messages are coalesced rather than left to pile up.
+#       
+#       With a #ProbeCache, where the server starts the stream for each seek time is remembered,
+#       so downloading the same video again can be planned without probing the server.
+#       Alternatively, the start of each part can be probed (in parallel) before downloading.
+#       
+#       The video may be downloaded from several origins (mirrors) at once; see #OriginPool.
+#       
+#       What the parts and the downloader do (opening streams, waiting for start & end times,
+#       reconnecting, joining...) can be recorded on a timeline with a #Tracer.
 #
 
 import os
+import io
+import re
+import base64
 import errno
+import json
+import time
+import tempfile
 import shutil
 import urllib2
 import struct
-import itertools
 import functools
-from collections import namedtuple
+import hashlib
+import heapq
+import mmap
+import multiprocessing
+import socket
+from collections import namedtuple, deque
 import Queue
-from threading import Thread
+from threading import Thread, Lock, Condition
+
+# fallocate() is only available on Linux; preallocation is skipped elsewhere
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (ImportError, OSError, AttributeError, TypeError):
+    _fallocate = None
+# fallocate() mode: allocate blocks without changing the apparent file size
+FALLOC_FL_KEEP_SIZE = 0x1
+
+#
+#   preallocate:
+#   @fileobj:       file
+#   @size:          number of bytes to reserve
+#
+#   Reserves disk space for the first @size bytes of @fileobj to reduce fragmentation.
+#   The file size is not changed, so truncation and resuming behave as before.
+#
+#   Returns:        True iff the space was reserved
+#
+def preallocate(fileobj, size):
+    if _fallocate is None or size <= 0:
+        return False
+    return _fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, 0, int(size) ) == 0
 
 # possible status values
 # %FAIL and %SUCCESS refer to downloading
@@ -84,57 +157,1411 @@ class Tag:
         return None
     
     #
-    #   is_video_keyframe:
-    #   
-    #   Returns:        True iff tag is a video keyframe
+    #   is_video_keyframe:
+    #   
+    #   Returns:        True iff tag is a video keyframe
+    #
+    def is_video_keyframe(self):
+        return self._type == Tag.VIDEO and (ord(self.body[0]) >> 4) == 1
+    
+    #
+    #   get_metadata_number:
+    #   @metadata:      metadata block (body of FLV tag)
+    #   @key:           key in metadata
+    #
+    #   Returns:        the 64-bit float associated with @key found in @metadata
+    #                   if not found, returns None
+    #
+    def get_metadata_number(self, key):
+        length_str = struct.pack("!I", len(key) )[2:]
+        index = self.body.find(length_str + key)
+        if index == -1:
+            return None
+        index += len(key) + 3
+        return struct.unpack("!d", self.body[index:index + 8])[0]
+    
+    #
+    #   write_data:
+    #   @fileobj:       file
+    #   @offset:        offset
+    #
+    #   Writes the tag @data to @fileobj after offsetting the timestamp by @offset
+    #
+    #   Returns:        the data written
+    #
+    def write_data(self, fileobj, offset):
+        timestamp = struct.pack("!i", self.timestamp + offset)
+        data = self.data[0:4] + timestamp[1:] + timestamp[0] + self.data[8:]
+        fileobj.write(data)
+        return data
+    
+    #
+    #   create:
+    #   @_type:         tag type
+    #   @timestamp:     tag timestamp
+    #   @body:          tag body
+    #   
+    #   Returns:        a new #Tag (with its data) made from @_type, @timestamp and @body
+    #
+    @staticmethod
+    def create(_type, timestamp, body):
+        ts = struct.pack("!i", timestamp)
+        data = chr(_type) + struct.pack("!I", len(body) )[1:] + ts[1:] + ts[0] + "\x00" * 3
+        data += body
+        data += struct.pack("!I", len(data) )
+        return Tag(_type, timestamp, body, data)
+
+#
+#   AMF0 helpers for reading/writing metadata (onMetaData) tag bodies
+#
+
+# key holding the padding in metadata written with room for a keyframe index
+INDEX_PADDING_KEY = "indexPadding"
+# size of each keyframe entry in the index (a number in each of 2 arrays)
+INDEX_ENTRY_SIZE = 2 * 9
+
+#
+#   amf_skip:
+#   @data:          AMF0 data
+#   @pos:           position of an AMF0 value in @data
+#   
+#   Returns:        position just after the value at @pos
+#                   Raises ValueError on unsupported/invalid data
+#
+def amf_skip(data, pos):
+    marker = ord(data[pos])
+    pos += 1
+    if marker == 0x00:
+        # number
+        return pos + 8
+    if marker == 0x01:
+        # boolean
+        return pos + 1
+    if marker == 0x02:
+        # string
+        return pos + 2 + struct.unpack("!H", data[pos:pos + 2])[0]
+    if marker == 0x0c:
+        # long string
+        return pos + 4 + struct.unpack("!I", data[pos:pos + 4])[0]
+    if marker in (0x05, 0x06, 0x0d):
+        # null, undefined, unsupported
+        return pos
+    if marker == 0x07:
+        # reference
+        return pos + 2
+    if marker == 0x0b:
+        # date
+        return pos + 10
+    if marker in (0x03, 0x08):
+        # object, ECMA array
+        if marker == 0x08:
+            pos += 4
+        while data[pos:pos + 3] != "\x00\x00\x09":
+            if pos + 3 > len(data):
+                raise ValueError("Unterminated AMF object")
+            pos += 2 + struct.unpack("!H", data[pos:pos + 2])[0]
+            pos = amf_skip(data, pos)
+        return pos + 3
+    if marker == 0x0a:
+        # strict array
+        count = struct.unpack("!I", data[pos:pos + 4])[0]
+        pos += 4
+        for i in range(count):
+            pos = amf_skip(data, pos)
+        return pos
+    raise ValueError("Unsupported AMF type {}".format(marker) )
+
+#
+#   amf_number:
+#   @number:        number
+#   
+#   Returns:        AMF0 encoding of @number
+#
+def amf_number(number):
+    return "\x00" + struct.pack("!d", number)
+
+#
+#   amf_boolean:
+#   @value:         boolean
+#   
+#   Returns:        AMF0 encoding of @value
+#
+def amf_boolean(value):
+    return "\x01" + chr(bool(value) )
+
+#
+#   amf_number_array:
+#   @numbers:       list of numbers
+#   
+#   Returns:        AMF0 encoding of @numbers as a strict array
+#
+def amf_number_array(numbers):
+    return "\x0a" + struct.pack("!I", len(numbers) ) + "".join(amf_number(i) for i in numbers)
+
+#
+#   amf_object:
+#   @props:         list of (key, AMF0-encoded value)
+#   @ecma:          whether to make an ECMA array instead of an object
+#   
+#   Returns:        AMF0 encoding of an object with @props
+#
+def amf_object(props, ecma = False):
+    if ecma:
+        data = "\x08" + struct.pack("!I", len(props) )
+    else:
+        data = "\x03"
+    for key, value in props:
+        data += struct.pack("!H", len(key) ) + key + value
+    return data + "\x00\x00\x09"
+
+#
+#   read_metadata:
+#   @body:          body of a metadata tag
+#   
+#   Returns:        (name, [(key, AMF0-encoded value), ...]) of the metadata in @body
+#                   Raises ValueError if @body can't be read
+#
+def read_metadata(body):
+    try:
+        pos = amf_skip(body, 0)
+        name = body[:pos]
+        marker = ord(body[pos])
+        if marker not in (0x03, 0x08):
+            raise ValueError("Metadata is not an object")
+        pos += 5 if marker == 0x08 else 1
+        
+        props = []
+        while body[pos:pos + 3] != "\x00\x00\x09" and pos < len(body):
+            keylen = struct.unpack("!H", body[pos:pos + 2])[0]
+            key = body[pos + 2:pos + 2 + keylen]
+            start = pos + 2 + keylen
+            pos = amf_skip(body, start)
+            props.append( (key, body[start:pos]) )
+    except (IndexError, struct.error):
+        raise ValueError("Truncated metadata")
+    return name, props
+
+# metadata keys describing only the audio or only the video
+AUDIO_METADATA_KEYS = ("audiocodecid", "audiodatarate", "audiosamplerate", "audiosamplesize", "audiosize", "stereo")
+VIDEO_METADATA_KEYS = ("videocodecid", "videodatarate", "framerate", "width", "height", "videosize")
+
+#
+#   select_metadata:
+#   @body:          body of a metadata tag
+#   @tag_types:     types of tags (Tag.AUDIO and/or Tag.VIDEO) being kept
+#   
+#   Returns:        metadata body like @body, but without the keys for streams not in @tag_types
+#                   (and with hasAudio/hasVideo set accordingly)
+#                   Raises ValueError if @body can't be read
+#
+def select_metadata(body, tag_types):
+    name, props = read_metadata(body)
+    dropped = set()
+    if Tag.AUDIO not in tag_types:
+        dropped.update(AUDIO_METADATA_KEYS + ("hasAudio",) )
+    if Tag.VIDEO not in tag_types:
+        dropped.update(VIDEO_METADATA_KEYS + ("hasVideo",) )
+    props = [i for i in props if i[0] not in dropped]
+    props.append( ("hasAudio", amf_boolean(Tag.AUDIO in tag_types) ) )
+    props.append( ("hasVideo", amf_boolean(Tag.VIDEO in tag_types) ) )
+    return name + amf_object(props, ecma = True)
+
+#
+#   index_metadata:
+#   @body:          body of a metadata tag
+#   @times:         keyframe times (in seconds)
+#   @positions:     keyframe file positions
+#   @numbers:       dictionary of number values to set (e.g. filesize)
+#   @size:          size of body to return, or None
+#   
+#   Makes a metadata body like @body, but with a "keyframes" object holding @times and @positions
+#   and the values in @numbers. The metadata is padded out to @size so that it can be
+#   rewritten in place later. If @size is None, the metadata is not padded at all.
+#   
+#   Returns:        the new metadata body, or None if it will not fit in @size
+#                   Raises ValueError if @body can't be read
+#
+def index_metadata(body, times, positions, numbers, size = None):
+    name, props = read_metadata(body)
+    replaced = set(numbers.keys() ) | set( ("keyframes", INDEX_PADDING_KEY) )
+    props = [i for i in props if i[0] not in replaced]
+    props += [(key, amf_number(value) ) for key, value in sorted(numbers.items() )]
+    props.append( ("keyframes", amf_object([("filepositions", amf_number_array(positions) ),
+                                            ("times", amf_number_array(times) )]) ) )
+    
+    # padding is a long string
+    padding = [(INDEX_PADDING_KEY, "\x0c" + struct.pack("!I", 0) )]
+    new_body = name + amf_object(props + padding, ecma = True)
+    if size is None:
+        return new_body
+    
+    length = size - len(new_body)
+    if length < 0:
+        return None
+    padding = [(INDEX_PADDING_KEY, "\x0c" + struct.pack("!I", length) + " " * length)]
+    return name + amf_object(props + padding, ecma = True)
+
+#
+#   update_metadata:
+#   @body:          body of a metadata tag
+#   @numbers:       dictionary of number values to set (e.g. duration)
+#   
+#   Returns:        metadata body like @body, with the values in @numbers set where @body already
+#                   has them as numbers, or None if that would change its size
+#                   Raises ValueError if @body can't be read
+#
+def update_metadata(body, numbers):
+    name, props = read_metadata(body)
+    props = [(key, amf_number(numbers[key]) if key in numbers and value[:1] == "\x00" else value) for key, value in props]
+    new_body = name + amf_object(props, ecma = body[len(name)] == "\x08")
+    if len(new_body) != len(body):
+        return None
+    return new_body
+
+#
+#   DataStream:
+#   
+#   A data stream keeping track of whether header for the stream
+#   is written yet and the timestamp of the last tag written for this stream.
+#
+class DataStream:
+    def __init__(self, header_written):
+        self.header_written = header_written
+        self.last_timestamp = -1
+
+#
+#   WriteBehindFile:
+#
+#   Wraps a file so that writes are done by a separate writer thread.
+#   Writes, seeks and truncations are put on a bounded queue and performed in order,
+#   so a slow disk only stalls the network reads once the queue is full.
+#   tell() reports the position as if all queued operations had already been done.
+#
+class WriteBehindFile:
+    # maximum number of queued operations (each write is usually a single tag)
+    QUEUE_SIZE = 512
+    
+    #
+    #   __init__:
+    #   @fileobj:       file object to write data to
+    #
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = fileobj.tell()
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        # first exception raised in the writer thread
+        self.error = None
+        self.closed = False
+        
+        self.thread = Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    #
+    #   run:
+    #
+    #   Writer thread; performs queued operations until "close" is received.
+    #   After an error, remaining operations are discarded (but still consumed).
+    #
+    def run(self):
+        while True:
+            op, arg = self.queue.get()
+            try:
+                if op == "close":
+                    self.fileobj.close()
+                    return
+                if self.error is not None:
+                    continue
+                if op == "write":
+                    self.fileobj.write(arg)
+                elif op == "seek":
+                    self.fileobj.seek(arg, 0)
+                elif op == "truncate":
+                    self.fileobj.truncate(arg)
+                elif op == "preallocate":
+                    self.fileobj.flush()
+                    preallocate(self.fileobj, arg)
+            except (IOError, OSError) as e:
+                if self.error is None:
+                    self.error = e
+    
+    #
+    #   put:
+    #   @op:            operation name
+    #   @arg:           argument for @op
+    #
+    #   Queues @op for the writer thread (blocks if the queue is full)
+    #   Raises any error from the writer thread.
+    #
+    def put(self, op, arg = None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put( (op, arg) )
+    
+    def write(self, data):
+        self.put("write", data)
+        self.position += len(data)
+    
+    def seek(self, offset, whence = 0):
+        # only absolute seeks are needed
+        self.put("seek", offset)
+        self.position = offset
+    
+    def tell(self):
+        return self.position
+    
+    def truncate(self, size = None):
+        if size is None:
+            size = self.position
+        self.put("truncate", size)
+    
+    def preallocate(self, size):
+        self.put("preallocate", size)
+    
+    #
+    #   close:
+    #
+    #   Waits for all queued operations to be done and closes the file.
+    #   Raises any error from the writer thread.
+    #
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put( ("close", None) )
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+#
+#   MemoryFile:
+#
+#   A growable in-memory buffer to download a part into, instead of a file.
+#   Once it grows past @limit bytes, its contents are moved to a temporary file
+#   and it carries on from there.
+#   Closing it does NOT discard the contents, so that it can still be joined.
+#
+class MemoryFile:
+    #
+    #   __init__:
+    #   @limit:         maximum number of bytes to keep in memory
+    #
+    def __init__(self, limit):
+        self.limit = limit
+        self.fileobj = io.BytesIO()
+        self.in_memory = True
+    
+    #
+    #   spill:
+    #
+    #   Moves the contents to a temporary file
+    #
+    def spill(self):
+        fileobj = tempfile.TemporaryFile()
+        # copied a bit at a time, so that there is never a second copy in memory
+        position = self.fileobj.tell()
+        self.fileobj.seek(0, 0)
+        shutil.copyfileobj(self.fileobj, fileobj)
+        fileobj.seek(position, 0)
+        self.fileobj = fileobj
+        self.in_memory = False
+    
+    def write(self, data):
+        if self.in_memory and self.fileobj.tell() + len(data) > self.limit:
+            self.spill()
+        self.fileobj.write(data)
+    
+    def read(self, size = -1):
+        return self.fileobj.read(size)
+    
+    def seek(self, offset, whence = 0):
+        self.fileobj.seek(offset, whence)
+    
+    def tell(self):
+        return self.fileobj.tell()
+    
+    def truncate(self, size = None):
+        if size is None:
+            size = self.fileobj.tell()
+        self.fileobj.truncate(size)
+    
+    def flush(self):
+        self.fileobj.flush()
+    
+    def preallocate(self, size):
+        # memory is allocated as needed
+        pass
+    
+    def close(self):
+        pass
+
+#
+#   Checksum:
+#
+#   A SHA-1 of the data written to a part, kept up to date as the data is written.
+#   Checkpoints are kept at keyframes, so that when the part is truncated back to a
+#   keyframe (to restart from there), the checksum can be rewound too.
+#
+class Checksum:
+    #
+    #   __init__:
+    #   @start:         position in the part from which data is hashed
+    #
+    def __init__(self, start = 0):
+        self.start = start
+        # position up to which data has been hashed
+        self.position = start
+        # None once the checksum can't be kept up to date
+        self.hash = hashlib.sha1()
+        # mapping from file positions to the hash up to there
+        self.checkpoints = {}
+    
+    #
+    #   update:
+    #   @data:          data written at self.position
+    #
+    def update(self, data):
+        if self.hash is not None:
+            self.hash.update(data)
+        self.position += len(data)
+    
+    #
+    #   checkpoint:
+    #
+    #   Keeps the hash up to the current position, so that it can be rewound to later
+    #
+    def checkpoint(self):
+        if self.hash is not None:
+            self.checkpoints[self.position] = self.hash.copy()
+    
+    #
+    #   rewind:
+    #   @position:      position the part is truncated back to
+    #
+    #   Rewinds the hash to @position. If there is no checkpoint there, the checksum is lost.
+    #
+    def rewind(self, position):
+        if position == self.position:
+            return
+        self.position = position
+        if position not in self.checkpoints:
+            self.hash = None
+            return
+        self.hash = self.checkpoints[position].copy()
+        for i in [i for i in self.checkpoints if i > position]:
+            del self.checkpoints[i]
+    
+    #
+    #   fork:
+    #   @position:      position of a checkpoint
+    #
+    #   Returns:        a new #Checksum carrying on from the checkpoint at @position
+    #                   (for another copy of the part written from there)
+    #
+    def fork(self, position):
+        checksum = Checksum(self.start)
+        checksum.position = position
+        checkpoint = self.checkpoints.get(position)
+        if checkpoint is None:
+            checksum.hash = None
+        else:
+            checksum.hash = checkpoint.copy()
+            checksum.checkpoints[position] = checkpoint.copy()
+        return checksum
+    
+    #
+    #   hexdigest:
+    #
+    #   Returns:        the digest of the data hashed so far, or None if it is not known
+    #
+    def hexdigest(self):
+        if self.hash is None:
+            return None
+        return self.hash.hexdigest()
+
+# bytes copied at a time when joining
+COPY_SIZE = 1024 * 1024
+
+#
+#   copy_hashed:
+#   @src:           file object to copy from (from its current position to the end)
+#   @dst:           file object to copy to, or None just to read @src
+#   @hashes:        list of hash objects to update with everything copied
+#   
+#   Returns:        number of bytes copied
+#
+def copy_hashed(src, dst, hashes):
+    size = 0
+    while True:
+        data = src.read(COPY_SIZE)
+        if not data:
+            return size
+        for h in hashes:
+            h.update(data)
+        if dst is not None:
+            dst.write(data)
+        size += len(data)
+
+# a problem found by verify_flv()
+Problem = namedtuple("Problem", "position timestamp message")
+
+#
+#   verify_flv:
+#   @filename:      FLV file (or part file without an FLV header)
+#   @max_gap:       largest allowed jump (in msecs) between timestamps of the same stream
+#   
+#   Checks every tag in @filename for sizes that don't match, timestamps that go backwards
+#   and gaps in the timestamps (e.g. between parts that were joined).
+#   The file is read only once, without decoding the tag bodies.
+#   
+#   Returns:        list of #Problem
+#
+def verify_flv(filename, max_gap = 1000):
+    return check_flv(filename, max_gap)[0]
+
+#
+#   check_flv:
+#   @filename:      see verify_flv()
+#   @max_gap:       see verify_flv()
+#   
+#   Returns:        (list of #Problem (see verify_flv()), dictionary of the first (position, timestamp)
+#                   and dictionary of the last timestamp of each tag type in @filename)
+#
+def check_flv(filename, max_gap = 1000):
+    problems = []
+    first_timestamps = {}
+    last_timestamps = {}
+    try:
+        f = open(filename, "rb")
+    except IOError as e:
+        return [Problem(None, None, "Can't open file: {}".format(e) )], first_timestamps, last_timestamps
+    with f:
+        position = 0
+        if f.read(3) == "FLV":
+            f.seek(9, 0)
+            if f.read(4) != "\x00" * 4:
+                problems.append(Problem(9, None, "Bad first tag size") )
+            position = 13
+        f.seek(position, 0)
+        
+        while True:
+            data = f.read(11)
+            if not data:
+                break
+            if len(data) != 11:
+                problems.append(Problem(position, None, "Truncated tag header") )
+                break
+            _type = ord(data[0])
+            size = struct.unpack("!I", "\x00" + data[1:4])[0]
+            timestamp = struct.unpack("!i", chr(ord(data[7]) & 0x7f) + data[4:7])[0]
+            
+            # only the flags at the start of the body are needed
+            body = f.read(min(size, 2) )
+            f.seek(size - len(body), 1)
+            fullsize = f.read(4)
+            if len(fullsize) != 4:
+                problems.append(Problem(position, timestamp, "Truncated tag") )
+                break
+            if struct.unpack("!I", fullsize)[0] != size + 11:
+                problems.append(Problem(position, timestamp, "Tag size {} doesn't match {}".format(
+                    struct.unpack("!I", fullsize)[0], size + 11) ) )
+            
+            # sequence headers have the timestamp of wherever they were written
+            if _type in (Tag.AUDIO, Tag.VIDEO) and size > 1:
+                if Tag(_type, timestamp, body, None).is_header() is None:
+                    last = last_timestamps.get(_type)
+                    if last is not None and timestamp < last:
+                        problems.append(Problem(position, timestamp, "Timestamp went back from {}".format(last) ) )
+                    elif last is not None and timestamp - last > max_gap:
+                        problems.append(Problem(position, timestamp, "Gap of {} msecs".format(timestamp - last) ) )
+                    first_timestamps.setdefault(_type, (position, timestamp) )
+                    last_timestamps[_type] = timestamp
+            position += size + 11 + 4
+    return problems, first_timestamps, last_timestamps
+
+# check_flv() for multiprocessing.Pool.map()
+def _check_flv(args):
+    return check_flv(*args)
+
+#
+#   check_part_files:
+#   @filenames:     list of FLV files (or parts)
+#   @results:       what check_flv() returned for each of @filenames
+#   @max_gap:       see verify_flv()
+#   
+#   Finds the part files of the same download among @filenames (@filename and @filename.partN,
+#   see #MultiPart_Downloader.save_stream()) and checks that each part carries on from the
+#   part before it (in time) without a gap or overlap, like verify_flv() does within a file.
+#   The problems are added to those of the later part.
+#
+def check_part_files(filenames, results, max_gap):
+    downloads = {}
+    for filename, result in zip(filenames, results):
+        match = re.match(r"(.*)\.part\d+$", filename)
+        downloads.setdefault(match.group(1) if match else filename, []).append( (filename, result) )
+    
+    for parts in downloads.values():
+        for _type in (Tag.AUDIO, Tag.VIDEO):
+            # (first (position, timestamp), last timestamp, filename, problems) of each part
+            ranges = sorted( ( (result[1][_type], result[2][_type], filename, result[0])
+                              for filename, result in parts if _type in result[1]), key = lambda i: i[0][1])
+            for (first, last, filename, problems), (next_first, next_last, next_filename, next_problems) in zip(ranges, ranges[1:]):
+                position, timestamp = next_first
+                if timestamp < last:
+                    next_problems.append(Problem(position, timestamp, "Overlaps {} by {} msecs".format(
+                        filename, last - timestamp) ) )
+                elif timestamp - last > max_gap:
+                    next_problems.append(Problem(position, timestamp, "Gap of {} msecs after {}".format(
+                        timestamp - last, filename) ) )
+
+#
+#   verify_files:
+#   @filenames:     list of FLV files (or parts)
+#   @max_gap:       see verify_flv()
+#   @processes:     number of files to check at once (default: number of CPUs)
+#   
+#   Checks each of @filenames with verify_flv() in parallel. Part files of the same download
+#   are also checked against each other (see check_part_files()).
+#   
+#   Returns:        list of (filename, list of #Problem), in the same order as @filenames
+#
+def verify_files(filenames, max_gap = 1000, processes = None):
+    if len(filenames) == 1:
+        return [(filenames[0], verify_flv(filenames[0], max_gap) )]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_check_flv, [(i, max_gap) for i in filenames])
+    finally:
+        pool.terminate()
+    check_part_files(filenames, results, max_gap)
+    return zip(filenames, [result[0] for result in results])
+
+#
+#   flv_has_video:
+#   @filename:      FLV file
+#   
+#   Returns:        False if @filename has an FLV header without the video flag, otherwise True
+#
+def flv_has_video(filename):
+    try:
+        with open(filename, "rb") as f:
+            header = f.read(13)
+    except IOError:
+        return True
+    if len(header) != 13 or header[:3] != "FLV":
+        return True
+    return bool(ord(header[4]) & 0x1)
+
+#
+#   flv_range:
+#   @filename:      FLV file (or part file without an FLV header)
+#   @has_video:     whether the download has video (for a file with an FLV header, only if
+#                   the header says so too)
+#   
+#   Finds which timestamps @filename covers, reading just the start of each tag (like verify_flv()).
+#   A download into @filename can be resumed from its last keyframe (see #StreamPart.analyse()).
+#   Keyframes are video keyframes or, without video, the first audio tag in each
+#   StreamPart.AUDIO_KEYFRAME_INTERVAL (roughly as #StreamPart.keeps_keyframe() keeps them).
+#   
+#   Returns:        (timestamp of the first audio/video tag, timestamp of the last keyframe)
+#                   or None if @filename can't be read or has no keyframes
+#
+def flv_range(filename, has_video = True):
+    first = last = None
+    previous_audio = None
+    try:
+        f = open(filename, "rb")
+    except IOError:
+        return None
+    with f:
+        filesize = os.fstat(f.fileno() ).st_size
+        header = f.read(13)
+        if header[:3] != "FLV":
+            f.seek(0, 0)
+        elif len(header) == 13:
+            has_video = has_video and bool(ord(header[4]) & 0x1)
+        
+        while True:
+            data = f.read(11)
+            if len(data) != 11:
+                break
+            _type = ord(data[0])
+            size = struct.unpack("!I", "\x00" + data[1:4])[0]
+            timestamp = struct.unpack("!i", chr(ord(data[7]) & 0x7f) + data[4:7])[0]
+            
+            # only the flags at the start of the body are needed
+            body = f.read(min(size, 2) )
+            f.seek(size - len(body) + 4, 1)
+            if f.tell() > filesize:
+                # truncated tag
+                break
+            
+            if _type in (Tag.AUDIO, Tag.VIDEO) and size > 1:
+                tag = Tag(_type, timestamp, body, None)
+                if tag.is_header() is None:
+                    if first is None:
+                        first = timestamp
+                    if has_video:
+                        if tag.is_video_keyframe():
+                            last = timestamp
+                    elif _type == Tag.AUDIO:
+                        if previous_audio is None or timestamp // StreamPart.AUDIO_KEYFRAME_INTERVAL != previous_audio // StreamPart.AUDIO_KEYFRAME_INTERVAL:
+                            last = timestamp
+                        previous_audio = timestamp
+    if last is None:
+        return None
+    return first, last
+
+#
+#   shutdown_stream:
+#   @stream:        stream opened with urllib2.urlopen() (or wrapping one in its "stream" attribute)
+#   
+#   Shuts down the socket under @stream, so that a read blocked on it (in another thread) returns.
+#   Closing @stream isn't enough for that, as the read holds on to the socket.
+#   
+#   Returns:        True iff there was a socket to shut down
+#
+def shutdown_stream(stream):
+    # (response -> socket file -> HTTP response -> socket file -> socket)
+    for i in range(8):
+        if stream is None:
+            break
+        if hasattr(stream, "shutdown"):
+            try:
+                stream.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                return False
+            return True
+        stream = getattr(stream, "stream", None) or getattr(stream, "fp", None) or getattr(stream, "_sock", None)
+    return False
+
+# progress of a part on a #ProgressBoard
+# @bytes:       bytes written; @timestamp: time (in msecs) written up to; @progress: from 0-1
+# @rate:        bytes written per second; @state: one of the ProgressBoard states
+PartProgress = namedtuple("PartProgress", "bytes timestamp progress rate state")
+
+#
+#   ProgressBoard:
+#
+#   The progress of each part, in shared memory. Each part updates its own entry in place
+#   and readers look at it whenever they like, so no messages need to be passed.
+#   The memory is an anonymous mmap (shared with threads and child processes) or, if a
+#   filename is given, a mapped file that other processes can open too.
+#
+class ProgressBoard:
+    # possible states of a part
+    STARTING = 0
+    WAITING = 1
+    DOWNLOADING = 2
+    RETRYING = 3
+    DONE = 4
+    FAILED = 5
+    
+    # magic, number of parts
+    HEADER = struct.Struct("<4sI")
+    MAGIC = "RTPB"
+    # one #PartProgress per part
+    ENTRY = struct.Struct("<4dI4x")
+    # minimum number of seconds over which the rate is measured
+    RATE_INTERVAL = 1.0
+    
+    #
+    #   __init__:
+    #   @numparts:      number of parts, or None to open an existing board in @filename
+    #   @filename:      file to keep the board in, or None
+    #   
+    #   Raises ValueError if @filename is not a board.
+    #
+    def __init__(self, numparts = None, filename = None):
+        self.filename = filename
+        if numparts is None:
+            with open(filename, "r+b") as f:
+                magic, numparts = self.HEADER.unpack(f.read(self.HEADER.size) )
+                if magic != self.MAGIC:
+                    raise ValueError("Not a progress board: " + filename)
+                self.map = mmap.mmap(f.fileno(), self.HEADER.size + numparts * self.ENTRY.size)
+        else:
+            size = self.HEADER.size + numparts * self.ENTRY.size
+            if filename is None:
+                self.map = mmap.mmap(-1, size)
+            else:
+                with open(filename, "w+b") as f:
+                    f.truncate(size)
+                    self.map = mmap.mmap(f.fileno(), size)
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, numparts)
+        self.numparts = numparts
+        # (time, bytes) each part's rate is being measured from (only used by the writer)
+        self.rate_start = [None] * numparts
+    
+    #
+    #   get:
+    #   @part:          part
+    #   
+    #   Returns:        #PartProgress of @part
+    #
+    def get(self, part):
+        return PartProgress(*self.ENTRY.unpack_from(self.map, self.HEADER.size + part * self.ENTRY.size) )
+    
+    #
+    #   put:
+    #   @part:          part
+    #   @kwargs:        fields of #PartProgress to change
+    #
+    def put(self, part, **kwargs):
+        entry = self.get(part)._replace(**kwargs)
+        self.ENTRY.pack_into(self.map, self.HEADER.size + part * self.ENTRY.size, *entry)
+    
+    #
+    #   update:
+    #   @part:          part
+    #   @_bytes:        bytes written so far
+    #   @timestamp:     time written up to
+    #   @progress:      progress from 0-1
+    #   
+    #   Updates the progress of @part (and its rate, every RATE_INTERVAL seconds)
+    #
+    def update(self, part, _bytes, timestamp, progress):
+        now = time.time()
+        start = self.rate_start[part]
+        if start is None or _bytes < start[1]:
+            # (re)started
+            self.rate_start[part] = (now, _bytes)
+            self.put(part, bytes = _bytes, timestamp = timestamp, progress = progress)
+        elif now - start[0] >= self.RATE_INTERVAL:
+            self.rate_start[part] = (now, _bytes)
+            rate = (_bytes - start[1]) / (now - start[0])
+            self.put(part, bytes = _bytes, timestamp = timestamp, progress = progress, rate = rate)
+        else:
+            self.put(part, bytes = _bytes, timestamp = timestamp, progress = progress)
+    
+    #
+    #   set_state:
+    #   @part:          part
+    #   @state:         new state of @part
+    #
+    def set_state(self, part, state):
+        if state != ProgressBoard.DOWNLOADING:
+            self.rate_start[part] = None
+            self.put(part, state = state, rate = 0)
+        else:
+            self.put(part, state = state)
+    
+    def close(self):
+        self.map.close()
+
+#
+#   stream_key:
+#   @url_fn:        function to generate URLs
+#   
+#   Returns:        key identifying the stream from @url_fn (its URL at the start)
+#
+def stream_key(url_fn):
+    return url_fn(0)
+
+#
+#   ProbeCache:
+#
+#   An on-disk cache of what opening a stream tells us: for each seek time, the timeBase
+#   (the keyframe the stream really starts at), and the header, first 2 metadata tags and
+#   duration of the video. Entries are kept per stream (see stream_key()).
+#   
+#   Entries expire after @ttl seconds. If the cache gets bigger than @max_size bytes, the
+#   least recently used entries are dropped.
+#   The cache is only read when created and written with save(); it can be shared by threads.
+#
+class ProbeCache:
+    #
+    #   __init__:
+    #   @filename:      file to keep the cache in, or None to only keep it in memory
+    #   @max_size:      maximum size of the cache (in bytes)
+    #   @ttl:           seconds after which entries expire
+    #
+    def __init__(self, filename, max_size = 1024 * 1024, ttl = 7 * 24 * 3600):
+        self.filename = filename
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = self.load()
+        # keys forgotten since the cache was read (so that they are removed from the file)
+        self.forgotten = set()
+    
+    #
+    #   load:
+    #   
+    #   Returns:        the unexpired entries in self.filename
+    #
+    def load(self):
+        if self.filename is None:
+            return {}
+        try:
+            with open(self.filename, "rb") as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        self.expire(entries)
+        return entries
+    
+    #
+    #   expired:
+    #   @created:       time an entry (or seek time) was added
+    #   
+    #   Returns:        whether it has expired
+    #
+    def expired(self, created):
+        return time.time() - created > self.ttl
+    
+    #
+    #   expire:
+    #   @entries:       dictionary of entries (like self.entries)
+    #   
+    #   Removes the entries and seek times in @entries that have expired
+    #
+    def expire(self, entries):
+        for key, entry in entries.items():
+            if self.expired(entry["created"]):
+                del entries[key]
+                continue
+            for seek, (timebase, created) in entry["seeks"].items():
+                if self.expired(created):
+                    del entry["seeks"][seek]
+    
+    #
+    #   save:
+    #   
+    #   Writes the cache to self.filename, along with anything added to the file since it was
+    #   read (e.g. by another process). Returns False if the cache can't be written.
+    #
+    def save(self):
+        if self.filename is None:
+            return False
+        with self.lock:
+            entries = self.load()
+            # (entries kept in memory for longer than the TTL aren't written back)
+            self.expire(self.entries)
+            for key in self.forgotten:
+                entries.pop(key, None)
+            self.forgotten = set()
+            for key, entry in self.entries.items():
+                if key not in entries or entries[key]["used"] <= entry["used"]:
+                    entries[key] = entry
+            
+            # keep the most recently used entries that fit
+            size = 2
+            self.entries = {}
+            for key, entry in sorted(entries.items(), key = lambda i: i[1]["used"], reverse = True):
+                size += len(json.dumps({key: entry}) )
+                if size > self.max_size:
+                    break
+                self.entries[key] = entry
+            
+            tmpname = self.filename + ".tmp"
+            try:
+                with open(tmpname, "wb") as f:
+                    json.dump(self.entries, f)
+                try:
+                    os.rename(tmpname, self.filename)
+                except OSError:
+                    # can't rename over an existing file on Windows
+                    os.remove(self.filename)
+                    os.rename(tmpname, self.filename)
+            except (IOError, OSError):
+                return False
+        return True
+    
+    #
+    #   entry:
+    #   @key:           stream key
+    #   
+    #   Returns:        the entry for @key (creating it if needed, or if it has expired), marked as just used
+    #
+    def entry(self, key):
+        now = time.time()
+        if key not in self.entries or self.expired(self.entries[key]["created"]):
+            self.entries[key] = dict(created = now, used = now, header = None, metadata = None,
+                                     duration = None, seeks = {})
+        self.entries[key]["used"] = now
+        return self.entries[key]
+    
+    #
+    #   add_stream:
+    #   @key:           stream key
+    #   @header:        FLV header
+    #   @mtags:         first 2 metadata #Tag
+    #   @duration:      duration of the video (in seconds)
+    #
+    def add_stream(self, key, header, mtags, duration):
+        with self.lock:
+            self.forgotten.discard(key)
+            entry = self.entry(key)
+            # the entry expires (along with the stream) a TTL after the stream was last added
+            entry["created"] = time.time()
+            entry["header"] = base64.b64encode(header)
+            entry["metadata"] = [base64.b64encode(i.data) for i in mtags]
+            entry["duration"] = duration
+    
+    #
+    #   add_seek:
+    #   @key:           stream key
+    #   @seek:          time (in msecs) the stream was opened at
+    #   @timebase:      time (in msecs) the stream really started at
+    #
+    def add_seek(self, key, seek, timebase):
+        with self.lock:
+            self.forgotten.discard(key)
+            self.entry(key)["seeks"][str(int(round(seek) ) )] = (timebase, time.time() )
+    
+    #
+    #   get_stream:
+    #   @key:           stream key
+    #   
+    #   Returns:        (header, [metadata tag data, ...], duration) for @key, or None (if not known
+    #                   or expired)
+    #
+    def get_stream(self, key):
+        with self.lock:
+            if key not in self.entries or self.entries[key]["duration"] is None:
+                return None
+            if self.expired(self.entries[key]["created"]):
+                return None
+            entry = self.entry(key)
+            return (base64.b64decode(entry["header"]), [base64.b64decode(i) for i in entry["metadata"]],
+                    entry["duration"])
+    
+    #
+    #   get_seek:
+    #   @key:           stream key
+    #   @seek:          time (in msecs) to open the stream at
+    #   
+    #   Returns:        time (in msecs) the stream would really start at, or None if not known
+    #                   (or expired)
+    #
+    def get_seek(self, key, seek):
+        with self.lock:
+            if key not in self.entries or self.expired(self.entries[key]["created"]):
+                return None
+            result = self.entry(key)["seeks"].get(str(int(round(seek) ) ) )
+            if result is None or self.expired(result[1]):
+                return None
+            return result[0]
+    
+    #
+    #   forget:
+    #   @key:           stream key
+    #   
+    #   Drops the entry for @key (e.g. because it is out of date)
+    #
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.forgotten.add(key)
+
+#
+#   OriginPool:
+#
+#   A set of origins (functions to generate URLs, e.g. for different mirrors or edge servers)
+#   for the same stream, and how well each of them is doing.
+#   Each time a stream is opened, the origin with the best throughput per connection
+#   (taking into account errors and the connections already open to it) is chosen.
+#   Origins that haven't been used yet are assumed to be as good as the best one, so they get tried.
+#
+class OriginPool:
+    # weight of the throughput measured so far, each time more is measured
+    DECAY = 0.8
+    
+    #
+    #   __init__:
+    #   @url_fns:       list of functions to generate URLs
+    #
+    def __init__(self, url_fns):
+        self.url_fns = list(url_fns)
+        self.lock = Lock()
+        # bytes read and seconds taken (both decaying), recent errors and open connections for each origin
+        self.bytes = [0.0] * len(self.url_fns)
+        self.seconds = [0.0] * len(self.url_fns)
+        self.errors = [0.0] * len(self.url_fns)
+        self.active = [0] * len(self.url_fns)
+    
+    #
+    #   rate:
+    #   @origin:        index of origin
+    #   
+    #   Returns:        throughput (bytes per second) of @origin, or None if not known
+    #
+    def rate(self, origin):
+        if not self.seconds[origin]:
+            return None
+        return self.bytes[origin] / self.seconds[origin]
+    
+    #
+    #   score:
+    #   @origin:        index of origin
+    #   
+    #   Returns:        the throughput a new connection to @origin is expected to get
+    #
+    def score(self, origin):
+        rate = self.rate(origin)
+        if rate is None:
+            rate = max([i for i in map(self.rate, range(len(self.url_fns) ) ) if i is not None] or [1.0])
+        return rate / (1 + self.errors[origin]) / (1 + self.active[origin])
+    
+    #
+    #   acquire:
+    #   
+    #   Chooses the origin with the best score() for a new connection
+    #   (which must be given back with release())
+    #   
+    #   Returns:        (index of origin, function to generate URLs)
+    #
+    def acquire(self):
+        with self.lock:
+            origin = max(range(len(self.url_fns) ), key = lambda i: (self.score(i), -i) )
+            self.active[origin] += 1
+            return origin, self.url_fns[origin]
+    
+    #
+    #   report:
+    #   @origin:        index of origin
+    #   @_bytes:        bytes read from @origin
+    #   @seconds:       seconds it took to read them
+    #
+    def report(self, origin, _bytes, seconds):
+        with self.lock:
+            self.bytes[origin] = self.bytes[origin] * self.DECAY + _bytes
+            self.seconds[origin] = self.seconds[origin] * self.DECAY + seconds
+    
+    #
+    #   release:
+    #   @origin:        index of origin
+    #   @failed:        whether the connection failed
+    #   
+    #   A connection to @origin has been closed. Errors count against an origin
+    #   until it has as many connections that didn't fail.
+    #
+    def release(self, origin, failed = False):
+        with self.lock:
+            self.active[origin] -= 1
+            if failed:
+                self.errors[origin] += 1
+            else:
+                self.errors[origin] /= 2
+
+#
+#   MessageQueue:
+#
+#   The queue the parts put their messages on for the downloader (see MultiPart_Downloader.wait_for_message()).
+#   Putting a message never blocks a part. Messages the download depends on (need_start, need_end,
+#   status, duration...) are always queued; there are only ever a few of them per part.
+#   Messages that are only for the log (debug and info) are queued while there are fewer than @limit
+#   of them waiting. Beyond that, each part's messages are coalesced into one (saying how many were
+#   left out, and with the last info message), so that slow signal handlers can't make the queue grow
+#   without bound.
+#
+class MessageQueue:
+    #
+    #   __init__:
+    #   @limit:         maximum number of debug/info messages to keep queued
+    #
+    def __init__(self, limit = 1000):
+        self.limit = limit
+        self.ready = Condition()
+        self.messages = deque()
+        # number of debug/info messages queued
+        self.informational = 0
+        # [number of messages, last info message] coalesced for each part (and its hedge)
+        self.coalesced = {}
+        # most messages queued at once, and number of messages coalesced in all
+        self.high_water = 0
+        self.total_coalesced = 0
+    
+    #
+    #   is_informational:
+    #   @message:       message
+    #   
+    #   Returns:        True iff @message is only a debug and/or info message
+    #
+    @staticmethod
+    def is_informational(message):
+        if "debug" not in message and "info" not in message:
+            return False
+        return all(key in ("part", "hedge", "debug", "info") for key in message)
+    
+    def put(self, message):
+        with self.ready:
+            if self.is_informational(message):
+                if self.informational >= self.limit:
+                    self.coalesce(message)
+                    return
+                self.informational += 1
+            self.messages.append(message)
+            self.high_water = max(self.high_water, len(self.messages) )
+            self.ready.notify()
+    
+    #
+    #   coalesce:
+    #   @message:       debug/info message that doesn't fit
+    #   
+    #   Adds @message to those coalesced for its part (or hedge), which are stood in for by one message
+    #   (where the first of them would have been)
+    #
+    def coalesce(self, message):
+        key = (message["part"], message.get("hedge", False) )
+        if key not in self.coalesced:
+            self.coalesced[key] = [0, None]
+            placeholder = dict(part = message["part"], coalesced = True)
+            if key[1]:
+                placeholder["hedge"] = True
+            self.messages.append(placeholder)
+            self.high_water = max(self.high_water, len(self.messages) )
+            self.ready.notify()
+        self.coalesced[key][0] += 1
+        if "info" in message:
+            self.coalesced[key][1] = message["info"]
+        self.total_coalesced += 1
+    
+    #
+    #   get:
+    #   @timeout:       seconds to wait for a message, or None to wait for ever
+    #   
+    #   Returns:        the next message; raises Queue.Empty if there is none by @timeout
+    #
+    def get(self, timeout = None):
+        with self.ready:
+            if not self.messages:
+                self.ready.wait(timeout)
+            if not self.messages:
+                raise Queue.Empty
+            message = self.messages.popleft()
+            if message.pop("coalesced", False):
+                count, info = self.coalesced.pop( (message["part"], message.get("hedge", False) ) )
+                message["debug"] = "{} messages left out".format(count)
+                if info is not None:
+                    message["info"] = info
+            elif self.is_informational(message):
+                self.informational -= 1
+            return message
+    
+    def empty(self):
+        with self.ready:
+            return not self.messages
+    
+    def qsize(self):
+        with self.ready:
+            return len(self.messages)
+
+#
+#   memory_usage:
+#   
+#   Returns:        bytes of memory this process has resident, or None if not known
+#                   (only known on Linux)
+#
+def memory_usage():
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+#
+#   Tracer:
+#
+#   Records timestamped events from the parts and the downloader, so that where parts
+#   waited on each other (or on the network) can be seen on a timeline.
+#   Each event is written to @filename as a line of JSON as soon as it happens (if @filename
+#   is given), and kept so that it can be saved in Chrome's trace event format afterwards
+#   (see save_chrome_trace()) to be viewed in chrome://tracing.
+#
+#   Each event is a dictionary with:
+#       event:          name of the event
+#       part:           part it happened in, or None for the downloader
+#       time:           seconds since the tracer was created
+#       duration:       seconds the event took (only for events that take time)
+#   and any other details of the event.
+#
+class Tracer:
+    #
+    #   __init__:
+    #   @filename:      file to write events to as JSON lines, or None
     #
-    def is_video_keyframe(self):
-        return self._type == Tag.VIDEO and (ord(self.body[0]) >> 4) == 1
+    def __init__(self, filename = None):
+        self.lock = Lock()
+        self.start = time.time()
+        self.events = []
+        self.file = None
+        if filename is not None:
+            self.file = open(filename, "wb")
     
     #
-    #   get_metadata_number:
-    #   @metadata:      metadata block (body of FLV tag)
-    #   @key:           key in metadata
+    #   event:
+    #   @name:          name of the event
+    #   @part:          part it happened in, or None for the downloader
+    #   @start:         time (from time.time()) at which the event started, or None if it
+    #                   happened just now
+    #   @details:       details of the event
     #
-    #   Returns:        the 64-bit float associated with @key found in @metadata
-    #                   if not found, returns None
+    def event(self, name, part = None, start = None, **details):
+        now = time.time()
+        details.update(event = name, part = part)
+        if start is None:
+            details["time"] = now - self.start
+        else:
+            details["time"] = start - self.start
+            details["duration"] = now - start
+        with self.lock:
+            self.events.append(details)
+            if self.file is not None:
+                self.file.write(json.dumps(details, sort_keys = True) + "\n")
+                # so that the trace is there even if the download crashes
+                self.file.flush()
+    
     #
-    def get_metadata_number(self, key):
-        length_str = struct.pack("!I", len(key) )[2:]
-        index = self.body.find(length_str + key)
-        if index == -1:
-            return None
-        index += len(key) + 3
-        return struct.unpack("!d", self.body[index:index + 8])[0]
+    #   chrome_trace:
+    #   
+    #   Returns:        the events in Chrome's trace event format (with a row for each part)
+    #
+    def chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+        trace = []
+        for part in sorted(set(i["part"] for i in events) ):
+            name = "downloader" if part is None else "part {}".format(part)
+            trace.append(dict(name = "thread_name", ph = "M", pid = 0, tid = 0 if part is None else part + 1,
+                              args = dict(name = name) ) )
+        for i in events:
+            args = dict( (key, value) for key, value in i.items() if key not in ("event", "part", "time", "duration") )
+            entry = dict(name = i["event"], pid = 0, tid = 0 if i["part"] is None else i["part"] + 1,
+                         ts = i["time"] * 1e6, args = args)
+            if "duration" in i:
+                entry.update(ph = "X", dur = i["duration"] * 1e6)
+            else:
+                entry.update(ph = "i", s = "t")
+            trace.append(entry)
+        return dict(traceEvents = trace, displayTimeUnit = "ms")
     
     #
-    #   write_data:
-    #   @fileobj:       file
-    #   @offset:        offset
+    #   save_chrome_trace:
+    #   @filename:      file to save to
     #
-    #   Writes the tag @data to @fileobj after offsetting the timestamp by @offset
+    def save_chrome_trace(self, filename):
+        with open(filename, "wb") as f:
+            json.dump(self.chrome_trace(), f)
+    
     #
-    def write_data(self, fileobj, offset):
-        fileobj.write(self.data[0:4])
-        timestamp = struct.pack("!i", self.timestamp + offset)
-        fileobj.write(timestamp[1:] + timestamp[0])
-        fileobj.write(self.data[8:])
-
-#
-#   DataStream:
-#   
-#   A data stream keeping track of whether header for the stream
-#   is written yet and the timestamp of the last tag written for this stream.
-#
-class DataStream:
-    def __init__(self, header_written):
-        self.header_written = header_written
-        self.last_timestamp = -1
+    #   close:
+    #
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
 #
 #       StreamPart:
 #
 class StreamPart:
+    # keyframes per second of video to reserve room for in the keyframe index
+    INDEX_KEYFRAMES_PER_SEC = 1
+    # msecs between the keyframes kept for streams without video (see keeps_keyframe())
+    AUDIO_KEYFRAME_INTERVAL = 1000
+    
     #
     #   __init__:
     #   @inqueue:               queue to receive input
@@ -143,14 +1570,19 @@ class StreamPart:
     #   @outfile:               file object to write data to
     #   @url_fn:                function to generate URLs
     #   @numparts:              total number of parts
+    #   @filesize:              estimated size of the whole video (for preallocation), or None
     #
-    def __init__(self, inqueue, outqueue, part, outfile, url_fn, numparts):
+    def __init__(self, inqueue, outqueue, part, outfile, url_fn, numparts, filesize = None):
         self.inqueue = inqueue
         self.outqueue = outqueue
         
         self.part = part
         self.outfile = outfile
         self.url_fn = url_fn
+        # function to open URLs with (e.g. to inject faults when testing)
+        self.urlopen = urllib2.urlopen
+        self.numparts = numparts
+        self.filesize = filesize
         
         self.is_lastpart = (self.part == numparts - 1)
         self.is_firstpart = (self.part == 0)
@@ -160,28 +1592,206 @@ class StreamPart:
                             Tag.VIDEO : DataStream(not self.is_firstpart) }
         # mapping from keyframe timestamps to file positions
         self.keyframes = {}
+        # checksum of the data written (see #Checksum)
+        self.checksum = Checksum()
+        # hex digest of the part, once it is done
+        self.digest = None
         # offset of current stream
         self.offset = 0
         # offset of start of this part
         self.real_offset = None
         # offset from where download is resumed (or started if could not resume)
         self.start_time = None
+        # time at which this part ends (may be set before starting if already known)
+        self.end_time = None
+        # timestamp subtracted from all tags written, so that the first part starts at 0
+        # (the first part finds this out itself; the others must be told before starting)
+        self.base = 0
+        
+        # whether the metadata written (first part only) should have room for a keyframe index
+        self.reserve_index = False
+        # types of tags to write (the others are read but dropped)
+        self.tag_types = (Tag.AUDIO, Tag.VIDEO)
+        # whether the stream has video; if not, every audio tag can be used as a keyframe
+        self.has_video = True
+        # timestamp of the last audio tag looked at by keeps_keyframe() in the current stream
+        self.previous_audio = None
+        
+        # #ProgressBoard to report progress on, or None
+        self.board = None
+        # #ProbeCache to remember (and look up) where the stream starts for each seek time, or None
+        self.cache = None
+        # #OriginPool to choose where to open streams from (instead of @url_fn), or None
+        self.origins = None
+        # stream currently open (see abort())
+        self.stream = None
+        # origin of the stream currently open, bytes read from it and when they started to be counted
+        self.origin = None
+        self.stream_bytes = 0
+        self.transfer_time = None
+        # where this part was planned to really start (if it is known before starting), or None
+        self.planned_offset = None
+        # #Tracer to record events on, or None
+        self.tracer = None
+        # whether this is a hedge (a second copy of the part, racing it from one of its keyframes)
+        # and the position in the part it was started from
+        self.hedge = False
+        self.hedge_position = None
+        # when this part started downloading (once it knew its start & end times), or None
+        self.downloading_since = None
         
         self.thread = None
         self.done = False
+        # whether the final message (with a status) has been put on outqueue
+        self.reported = False
         self.need_start = None
         self.need_end = None
+        
+        # number of times this part has been retried
+        self.retries = 0
+        # seconds to wait before starting
+        self.delay = 0
+    
+    #
+    #   take_over:
+    #   @previous:      #StreamPart for the same part that failed
+    #   
+    #   Carries on from where @previous left off; its keyframes (so that downloading restarts
+    #   from the last one), checksum, written headers, start & end times are all taken over.
+    #   If @previous failed before its first keyframe, there is nothing to carry on from:
+    #   self.outfile is emptied and the part (headers and all) is written again from the start.
+    #
+    def take_over(self, previous):
+        if previous.keyframes:
+            self.keyframes = dict(previous.keyframes)
+            self.checksum = previous.checksum
+            for _type, data_stream in previous.data_streams.items():
+                self.data_streams[_type].header_written = data_stream.header_written
+        else:
+            # the checksum and headers written are left as for a new part
+            self.outfile.seek(0)
+            self.outfile.truncate(0)
+        self.start_time = previous.start_time
+        self.real_offset = previous.real_offset
+        self.base = previous.base
+        self.end_time = previous.end_time
+        self.retries = previous.retries + 1
+    
+    #
+    #   hedge_from:
+    #   @previous:      #StreamPart for the same part, still downloading
+    #   @keyframe:      one of the keyframes of @previous
+    #   
+    #   Sets this part up as a hedge of @previous, racing it to the end from @keyframe.
+    #   Everything is written where @previous would write it (and hashed as if it had), so that
+    #   whichever copy finishes first can be kept (see MultiPart_Downloader.splice_hedge()).
+    #
+    def hedge_from(self, previous, keyframe):
+        self.hedge = True
+        self.hedge_position = previous.keyframes[keyframe]
+        self.keyframes = {keyframe : self.hedge_position}
+        self.checksum = previous.checksum.fork(self.hedge_position)
+        for _type, data_stream in previous.data_streams.items():
+            self.data_streams[_type].header_written = data_stream.header_written
+        self.start_time = previous.start_time
+        self.real_offset = previous.real_offset
+        self.base = previous.base
+        self.end_time = previous.end_time
+    
+    #
+    #   is_keyframe:
+    #   @tag:           #Tag
+    #   
+    #   Returns:        True iff @tag is a point at which the stream can be started
+    #                   i.e. a video keyframe, or any audio tag if the stream has no video
+    #
+    def is_keyframe(self, tag):
+        if self.has_video:
+            return tag.is_video_keyframe()
+        return tag._type == Tag.AUDIO and not tag.is_header()
+    
+    #
+    #   keeps_keyframe:
+    #   @tag:           #Tag
+    #   @timestamp:     timestamp of @tag in the stream
+    #   
+    #   Returns:        True iff @tag is a keyframe (see is_keyframe()) to keep in self.keyframes
+    #   
+    #   Without video, only the first audio tag in each AUDIO_KEYFRAME_INTERVAL is kept, rather than
+    #   every one (each of which would be checkpointed, journaled and indexed). This only depends
+    #   on the stream, so the same tags are kept when it is read again after a restart.
+    #   self.previous_audio has to be reset to None for each stream read.
+    #
+    def keeps_keyframe(self, tag, timestamp):
+        if not self.is_keyframe(tag):
+            return False
+        if self.has_video:
+            return True
+        previous, self.previous_audio = self.previous_audio, timestamp
+        return previous is None or timestamp // self.AUDIO_KEYFRAME_INTERVAL != previous // self.AUDIO_KEYFRAME_INTERVAL
+    
+    #
+    #   select_header:
+    #   @header:        FLV header
+    #   
+    #   Returns:        @header with the audio/video flags cleared for streams not in self.tag_types
+    #
+    def select_header(self, header):
+        flags = ord(header[4])
+        if Tag.AUDIO not in self.tag_types:
+            flags &= ~0x4
+        if Tag.VIDEO not in self.tag_types:
+            flags &= ~0x1
+        return header[:4] + chr(flags) + header[5:]
     
     #
     #   put_message:
     #   @kwargs:        message
     #   
     #   Puts the message given in the dict @kwargs to #StreamPart.outqueue, with part=part
+    #   (and if it has a status, updates the state on self.board)
     #
     def put_message(self, **kwargs):
+        if "status" in kwargs:
+            self.reported = True
+            self.set_state(ProgressBoard.DONE if kwargs["status"] == Status.SUCCESS else ProgressBoard.FAILED)
+            self.trace("finished" if kwargs["status"] == Status.SUCCESS else "failed")
         kwargs["part"] = self.part
+        if self.hedge:
+            kwargs["hedge"] = True
         self.outqueue.put(kwargs)
     
+    #
+    #   set_state:
+    #   @state:         new state of this part on self.board
+    #
+    def set_state(self, state):
+        if self.board is not None:
+            self.board.set_state(self.part, state)
+    
+    #
+    #   trace:
+    #   @event:         name of the event
+    #   @start:         time (from time.time()) at which the event started, or None
+    #   @details:       details of the event
+    #   
+    #   Records the event on self.tracer (if any); see #Tracer.event()
+    #
+    def trace(self, event, start = None, **details):
+        if self.tracer is not None:
+            self.tracer.event(event, self.part, start, **details)
+    
+    #
+    #   report_progress:
+    #   @timestamp:     timestamp (in the stream) written up to
+    #   @progress:      progress from 0-1
+    #   
+    #   Updates the progress of this part on self.board
+    #
+    def report_progress(self, timestamp, progress):
+        if self.board is not None:
+            self.board.update(self.part, self.outfile.tell(), timestamp - self.base, progress)
+    
     #
     #   convenience functions to put info, debug messages on outqueue
     #
@@ -204,7 +1814,7 @@ class StreamPart:
         if len(header) != length:
             return None
         return header
-
+    
     #
     #       get_next_tag:
     #       @stream:        stream
@@ -238,32 +1848,86 @@ class StreamPart:
     #   restart_from_last_keyframe:
     #   
     #   Attempt to open a stream on some keyframe in self.keyframes (starting from last keyframe)
+    #   Keyframes that self.cache says the stream would not start at are skipped.
     #   
     #   Returns:        None on failure or
     #                   (stream, header, [tag1, tag2], offset)
     #
     def restart_from_last_keyframe(self):
         for kf in sorted(self.keyframes.keys(), reverse = True):
+            if self.cache is not None:
+                offset = self.cache.get_seek(stream_key(self.url_fn), kf)
+                if offset is not None and round(offset) not in self.keyframes:
+                    self.debug_message("Skipping keyframe {}; stream starts at unknown keyframe {}".format(kf, offset) )
+                    continue
             result = self.open_stream(start = kf)
             if result is not None:
                 stream, header, mtags, offset = result
                 offset = round(offset)
                 if offset in self.keyframes:
                     # new stream starts at a known keyframe (which may or may not be kf)
+                    self.trace("truncate", position = self.keyframes[offset], keyframe = offset)
                     self.outfile.seek(self.keyframes[offset], 0)
+                    self.checksum.rewind(self.keyframes[offset])
                     return result
                 # new stream doesn't start at the keyframe
                 self.info_message("Stream starts at unknown keyframe {}".format(offset) )
-                stream.close()
+                self.close_stream(stream)
         return None
     
+    #
+    #   report_transfer:
+    #   @force:         whether to report even if it is less than a second since the last report
+    #   
+    #   Reports the bytes read since the last report to self.origins
+    #
+    def report_transfer(self, force = False):
+        if self.origin is None:
+            return
+        now = time.time()
+        if force or now - self.transfer_time >= 1:
+            # time spent connecting (or failing to) is not counted; errors are scored separately
+            if self.stream_bytes:
+                self.origins.report(self.origin, self.stream_bytes, now - self.transfer_time)
+            self.stream_bytes = 0
+            self.transfer_time = now
+    
+    #
+    #   close_stream:
+    #   @stream:        stream opened by open_stream(), or None
+    #   @failed:        whether the stream failed (so its origin is scored lower)
+    #   
+    #   Closes @stream and gives its origin back to self.origins
+    #
+    def close_stream(self, stream, failed = False):
+        self.stream = None
+        if stream is not None:
+            stream.close()
+        if self.origin is not None:
+            self.report_transfer(force = True)
+            self.origins.release(self.origin, failed)
+            self.origin = None
+    
+    #
+    #   abort:
+    #   
+    #   Orders the part to stop (from another thread), even if it is stuck reading a stalled
+    #   stream: the stream is shut down, so that the read returns
+    #
+    def abort(self):
+        self.inqueue.put(Status.FAIL)
+        stream = self.stream
+        if stream is not None:
+            shutdown_stream(stream)
+    
     #
     #   open_stream:
     #   @start:         time at which to start
     #   @analyse:       whether we are analysing a previous download
     #   
     #   Gets the header, first 2 metadata tags and timeBase value in second metadata tag from stream
-    #   If @analyse is false, stream is URL opened at @start
+    #   If @analyse is false, stream is URL opened at @start (and the timeBase is added to self.cache)
+    #   from self.url_fn, or the origin chosen by self.origins. It must be closed with close_stream().
     #   Otherwise, the stream is self.outfile (and @start is ignored)
     #   
     #   If @analyse is true and it is NOT the first part, the header, metadata etc. is not retrieved
@@ -283,20 +1947,32 @@ class StreamPart:
             on_error = self.debug_message
         else:
             on_error = self.info_message
-            url = self.url_fn(start / 1000.0)
+            if self.origins is None:
+                url = self.url_fn(start / 1000.0)
+            else:
+                self.origin, url_fn = self.origins.acquire()
+                self.stream_bytes = 0
+                self.transfer_time = time.time()
+                url = url_fn(start / 1000.0)
             # try to open the url
             self.debug_message("Opening " + url)
+            opened = time.time()
             try:
-                stream = urllib2.urlopen(url)
+                stream = self.urlopen(url)
+                self.stream = stream
+                self.trace("url-opened", opened, url = url, origin = self.origin)
             except IOError as e:
                 self.info_message("Failed to open {}: {}".format(url, e) )
+                self.trace("open-failed", opened, url = url, reason = str(e) )
+                self.close_stream(None, failed = True)
                 return None
-        
+            
             # stream must be FLV
             stream_mime = stream.info().gettype()
             if stream_mime != "video/x-flv":
                 self.info_message("{} is {}, not FLV".format(url, stream_mime) )
-                stream.close()
+                self.trace("open-failed", opened, url = url, reason = stream_mime)
+                self.close_stream(stream, failed = True)
                 return None
         
         # read the one header
@@ -304,10 +1980,11 @@ class StreamPart:
         if header is None:
             on_error("Incomplete FLV Header")
             if not analyse:
-                stream.close()
+                self.trace("open-failed", opened, url = url, reason = "Incomplete FLV Header")
+                self.close_stream(stream, failed = True)
             return None
         self.debug_message("Read FLV header")
-    
+        
         # read first 2 metadata tags
         mtags = []
         for i in range(2):
@@ -315,20 +1992,28 @@ class StreamPart:
             if tag is None or tag._type != Tag.METADATA:
                 on_error("Missing metadata")
                 if not analyse:
-                    stream.close()
+                    self.trace("open-failed", opened, url = url, reason = "Missing metadata")
+                    self.close_stream(stream, failed = True)
                 return None
             mtags.append(tag)
-    
+        
         # second tag - should have timeBase key
         offset = mtags[1].get_metadata_number("timeBase")
         if offset is None:
             on_error("Metadata missing timeBase key")
             if not analyse:
-                stream.close()
+                self.trace("open-failed", opened, url = url, reason = "Metadata missing timeBase key")
+                self.close_stream(stream, failed = True)
             return None
         offset *= 1000
         self.debug_message("Found timebase ({})".format(offset) )
         
+        if not analyse:
+            self.trace("timebase", opened, seek = start, offset = offset)
+            # video flag in header
+            self.has_video = bool(ord(header[4]) & 0x1)
+            if self.cache is not None:
+                self.cache.add_seek(stream_key(self.url_fn), start, offset)
         return stream, header, mtags, offset
     
     #
@@ -359,6 +2044,8 @@ class StreamPart:
                 # stream closed prematurely
                 yield None
                 return
+            if not analyse:
+                self.stream_bytes += len(tag.data)
             
             handled_tag = False
             if tag._type in self.data_streams:
@@ -372,8 +2059,9 @@ class StreamPart:
                 found_first_tag = True
                 if analyse:
                     self.offset = tag.timestamp
-                    self.real_offset = tag.timestamp
+                    self.real_offset = tag.timestamp + self.base
                 else:
+                    self.trace("first-tag", timestamp = tag.timestamp, offset = self.offset)
                     self.offset -= tag.timestamp
                     duration += int(tag.timestamp)
             
@@ -388,7 +2076,7 @@ class StreamPart:
                 
                 # downloaded as much as needed
                 if tag.timestamp >= duration:
-                    if (int(tag.timestamp) == duration and tag.is_video_keyframe() ) or self.is_lastpart:
+                    if (int(tag.timestamp) == duration and self.is_keyframe(tag) ) or self.is_lastpart:
                         break
                     elif tag.timestamp > duration:
                         # not last part and didn't find next part's key frame
@@ -404,8 +2092,9 @@ class StreamPart:
     #   analyse:
     #   
     #   Analyse a previous (incomplete) download saved in self.outfile
-    #   Basically fills in the self.keyframes dictionary
-    #   If first part, will also get the video duration (if possible)
+    #   Basically fills in the self.keyframes dictionary (and self.checksum)
+    #   If first part, will also get the video duration (if possible) and self.base
+    #   (from the timeBase it wrote)
     #
     def analyse(self):
         try:
@@ -419,8 +2108,17 @@ class StreamPart:
                         # no duration key; download is bad 
                         self.info_message("Metadata missing duration key", status = Status.FAIL)
                         return
-                    self.put_message(filesize = mtags[0].get_metadata_number("filesize") )
-                    self.put_message(duration = full_duration)
+                    self.filesize = mtags[0].get_metadata_number("filesize")
+                    self.base = offset
+                    self.put_message(filesize = self.filesize)
+                    self.put_message(duration = full_duration, base = self.base)
+                    # the metadata is not part of the checksum
+                    self.checksum = Checksum(self.outfile.tell() )
+                
+                # keyframes are found the same way they were when writing, as far as the files can tell:
+                # it has video if it was kept and the first part's header says so (see flv_has_video())
+                self.has_video = Tag.VIDEO in self.tag_types and (self.has_video if header is None else bool(ord(header[4]) & 0x1) )
+                self.previous_audio = None
                 
                 # fill in the self.keyframes dictionary
                 for tag in self.read_tag_stream(self.outfile, analyse = True):
@@ -428,12 +2126,34 @@ class StreamPart:
                         continue
                     if tag.is_header():
                         self.data_streams[tag._type].header_written = True
-                    elif tag.is_video_keyframe():
-                        self.keyframes[tag.timestamp] = self.outfile.tell() - len(tag.data)
+                    elif self.keeps_keyframe(tag, tag.timestamp + self.base):
+                        self.keyframes[tag.timestamp + self.base] = self.outfile.tell() - len(tag.data)
+                        self.checksum.checkpoint()
+                    self.checksum.update(tag.data)
         finally:
             # seek back to start of file
             self.outfile.seek(0, 0)
     
+    #
+    #   reserve_index_metadata:
+    #   @tag:                       the onMetaData tag
+    #   @duration:                  duration of the video (in seconds)
+    #   
+    #   Returns:                    @tag padded with enough room for a keyframe index (at
+    #                               INDEX_KEYFRAMES_PER_SEC) or @tag itself if it can't be read
+    #
+    def reserve_index_metadata(self, tag, duration):
+        try:
+            # (with room for the filesize and duration written along with the index)
+            body = index_metadata(tag.body, [], [], dict(filesize = 0, duration = 0) )
+        except ValueError as e:
+            self.info_message("Can't reserve keyframe index: {}".format(e) )
+            return tag
+        size = len(body) + int(duration * self.INDEX_KEYFRAMES_PER_SEC + 1) * INDEX_ENTRY_SIZE
+        body = index_metadata(tag.body, [], [], {}, size)
+        self.debug_message("Reserved {} bytes for keyframe index".format(size) )
+        return Tag.create(tag._type, tag.timestamp, body)
+    
     #
     #   save_stream_part:
     #   @resume:                    whether to resume a previous download
@@ -447,12 +2167,17 @@ class StreamPart:
     #   Instead, it will pass appropriate messages to self.outqueue for emission
     #   These messages are all dictionaries
     #
-    #   If this is the first part, first message contains "duration"
+    #   If this is the first part, first message contains "duration" (and "base")
     #   All parts then output need_start = True (wait for a start time on self.inqueue) of
     #       need_start = False (start time already obtained; self.start_time holds a valid number)
     #
+    #   If self.start_time is set before calling this function, the part will not wait for a start time.
+    #   If self.planned_offset is also set and the stream does not really start there, the part fails
+    #   (with stale = True in the message).
+    #
     #   The stream will then be opened at self.start_time
     #   All parts then output need_end = True, and wait for end_time on self.inqueue
+    #   (or need_end = False if self.end_time was set before calling this function)
     #   
     #   The stream is saved and it closes prematurely, the function tries to start downloading
     #   again from the point it left off
@@ -463,20 +2188,67 @@ class StreamPart:
     #   In addition to all of the above, EVERY message will have a "part" key.
     #   
     #   If @resume is true, will attempt to resume from a previous download.
+    #   If self.delay is set, waits that many seconds first.
+    #   
+    #   Progress (and the state of this part) is kept up to date on self.board.
+    #   If the part can't be written (e.g. the disk is full), it fails like it would if the
+    #   stream couldn't be opened.
     #   
     def save_stream_part(self, resume = False):
+        try:
+            try:
+                self.download_part(resume)
+            finally:
+                # however the part ended, its file is closed (and the thread writing it stopped)
+                self.outfile.close()
+        except (IOError, OSError) as e:
+            # only one status is ever reported
+            if not self.reported:
+                self.info_message("Failed to write part: {}".format(e), status = Status.FAIL)
+    
+    #
+    #   download_part:
+    #   @resume:        whether to attempt to resume from a previous download
+    #   
+    #   Does the work of save_stream_part(), raising any error writing the part
+    #   (self.outfile is left for save_stream_part() to close)
+    #
+    def download_part(self, resume = False):
+        self.set_state(ProgressBoard.RETRYING if self.delay else ProgressBoard.STARTING)
+        self.trace("part-start", start_time = self.start_time, end_time = self.end_time, retries = self.retries,
+                   resume = resume)
+        if self.delay:
+            # wait before starting (unless ordered to stop)
+            waited = time.time()
+            try:
+                message = self.inqueue.get(timeout = self.delay)
+            except Queue.Empty:
+                message = None
+            self.trace("delay", waited)
+            if message == Status.FAIL:
+                self.debug_message("Ordered to stop", status = Status.FAIL)
+                return
+        
         if resume:
             self.analyse()
+        # from now on, writes to disk are done by a separate thread
+        if isinstance(self.outfile, file):
+            self.outfile = WriteBehindFile(self.outfile)
         
         # attempt to resume
         result = self.restart_from_last_keyframe()
         resume_failed = (result is None)
+        if resume_failed and self.hedge:
+            # a hedge has to carry on from the other copy of the part
+            self.debug_message("Could not hedge from keyframe", status = Status.FAIL)
+            return
         
         if resume_failed:
-            # no resume
+            # no resume; the part is written from the start
             self.real_offset = None
-            # first part always starts at 0
-            if self.is_firstpart:
+            self.checksum = Checksum()
+            # first part starts at 0 (unless told otherwise)
+            if self.is_firstpart and self.start_time is None:
                 self.start_time = 0
         else:
             # resume successful! set self.start_time
@@ -485,13 +2257,18 @@ class StreamPart:
             self.info_message("Resuming from {}".format(self.offset) )
         
         # indicate we need self.start_time or self.start_time is now a number
-        self.need_start = (self.start_time is None)
-        self.put_message(need_start = self.need_start)
+        # (self.need_start may be changed by the downloader as soon as it is set)
+        need_start = (self.start_time is None)
+        self.need_start = need_start
+        self.put_message(need_start = need_start)
         
         if resume_failed:
-            if self.need_start:
+            if need_start:
                 # wait for start_time
+                self.set_state(ProgressBoard.WAITING)
+                waited = time.time()
                 self.start_time = self.inqueue.get()
+                self.trace("wait-start-time", waited, start_time = self.start_time)
                 if self.start_time == Status.FAIL:
                     self.debug_message("Ordered to stop", status = Status.FAIL)
                     return None
@@ -503,6 +2280,15 @@ class StreamPart:
                 self.put_message(status = Status.FAIL)
                 return
             stream, header, mtags, self.offset = result
+            if self.planned_offset is not None and round(self.offset) != round(self.planned_offset):
+                # planned from out-of-date information; the parts won't line up
+                self.close_stream(stream)
+                self.info_message("Stream starts at {}, not at {} as planned".format(self.offset, self.planned_offset),
+                                  status = Status.FAIL, stale = True)
+                return
+            if self.is_firstpart:
+                # everything is written relative to the start of the first part
+                self.base = int(round(self.offset) )
         
         if self.real_offset is None:
             self.real_offset = self.offset
@@ -513,51 +2299,82 @@ class StreamPart:
             # only first part will write header and extract duration, filesize metadata
             # if resume succeeded, its already been done
             if resume_failed and self.is_firstpart:
-                self.outfile.write(header)
+                self.outfile.write(self.select_header(header) )
                 self.debug_message("Wrote FLV header")
                 
                 full_duration = mtags[0].get_metadata_number("duration")
                 if full_duration is None:
                     self.info_message("Metadata missing duration key", status = Status.FAIL)
                     return
-                self.put_message(filesize = mtags[0].get_metadata_number("filesize") )
-                self.put_message(duration = full_duration)
-            
+                self.filesize = mtags[0].get_metadata_number("filesize")
+                self.put_message(filesize = self.filesize)
+                self.put_message(duration = full_duration, base = self.base)
+                if self.cache is not None:
+                    self.cache.add_stream(stream_key(self.url_fn), header, mtags, full_duration)
+                
+                if tuple(self.tag_types) != (Tag.AUDIO, Tag.VIDEO):
+                    try:
+                        mtags[0] = Tag.create(mtags[0]._type, mtags[0].timestamp, select_metadata(mtags[0].body, self.tag_types) )
+                    except ValueError as e:
+                        self.info_message("Can't update metadata: {}".format(e) )
+                if self.reserve_index:
+                    mtags[0] = self.reserve_index_metadata(mtags[0], full_duration)
                 mtags[0].write_data(self.outfile, 0)
                 mtags[1].write_data(self.outfile, 0)
+                # the metadata is rewritten when joining, so it is not part of the checksum
+                self.checksum = Checksum(self.outfile.tell() )
             
-            # indicate we need an end_time
-            self.need_end = True
-            self.put_message(need_end = self.need_end)
-            # now get end_time
-            end_time = self.inqueue.get()
-            if end_time == Status.FAIL:
-                self.debug_message("Ordered to stop", status = Status.FAIL)
-                return
-            self.debug_message("Got end_time ({})".format(end_time) )
+            # reserve roughly this part's share of the video on disk
+            if self.filesize:
+                self.outfile.preallocate(self.filesize / self.numparts)
+            
+            # indicate whether we need an end_time
+            # (self.need_end may be changed by the downloader as soon as it is set)
+            need_end = (self.end_time is None)
+            self.need_end = need_end
+            self.put_message(need_end = need_end)
+            if need_end:
+                # now get end_time
+                self.set_state(ProgressBoard.WAITING)
+                waited = time.time()
+                self.end_time = self.inqueue.get()
+                self.trace("wait-end-time", waited, end_time = self.end_time)
+                if self.end_time == Status.FAIL:
+                    self.debug_message("Ordered to stop", status = Status.FAIL)
+                    return
+                self.debug_message("Got end_time ({})".format(self.end_time) )
             
             # loop - keep going until WHOLE part downloaded (i.e. accounting for incomplete downloads)
+            self.downloading_since = time.time()
             while True:
+                self.set_state(ProgressBoard.DOWNLOADING)
+                downloading = time.time()
                 # timestamp for the last audio/video/keyframe tag received
                 self.data_streams[Tag.AUDIO].last_timestamp = -1
                 self.data_streams[Tag.VIDEO].last_timestamp = -1
+                self.previous_audio = None
                 
                 # read tags from stream
                 # at the end, tag is None if stream prematurely ended
                 incomplete = False
                 tag = None
-                for tag in self.read_tag_stream(stream, end_time = end_time):
+                for tag in self.read_tag_stream(stream, end_time = self.end_time):
                     if tag is None:
                         incomplete = True
                         break
-                    tag.write_data(self.outfile, self.offset)
                     if tag.is_header():
                         self.data_streams[tag._type].header_written = True
-                    elif tag.is_video_keyframe():
-                        # new keyframe
-                        self.keyframes[round(tag.timestamp + self.offset)] = self.outfile.tell() - len(tag.data)
-                        # report progress
-                        self.put_message(progress = float(tag.timestamp + self.offset - self.real_offset) / (end_time - self.real_offset) )
+                    elif self.keeps_keyframe(tag, tag.timestamp + self.offset):
+                        # new keyframe (if dropped, the position the next tag will be written to)
+                        self.keyframes[round(tag.timestamp + self.offset)] = self.outfile.tell()
+                        self.checksum.checkpoint()
+                        self.trace("keyframe", timestamp = tag.timestamp + self.offset, position = self.outfile.tell() )
+                        self.report_progress(tag.timestamp + self.offset,
+                            float(tag.timestamp + self.offset - self.real_offset) / (self.end_time - self.real_offset) )
+                        self.report_transfer()
+                    # tags of other types are dropped
+                    if tag._type in self.tag_types:
+                        self.checksum.update(tag.write_data(self.outfile, self.offset - self.base) )
                     
                     # check if we've been ordered to stop
                     try:
@@ -568,17 +2385,29 @@ class StreamPart:
                     except Queue.Empty:
                         pass
                 
-                stream.close()
+                self.close_stream(stream, failed = incomplete)
                 # timestamp of last written tag
                 prev_t = max(i.last_timestamp for i in self.data_streams.values() )
+                self.trace("download", downloading, until = prev_t, incomplete = incomplete)
                 
                 if not incomplete:
                     # finished successfully
                     break
                 
+                # (the stream may have been cut off because the part was ordered to stop; see abort())
+                try:
+                    if self.inqueue.get_nowait() == Status.FAIL:
+                        self.debug_message("Ordered to stop", status = Status.FAIL)
+                        return
+                except Queue.Empty:
+                    pass
+                
                 # otherwise: incomplete; restart stream at last possible keyframe
                 self.info_message("Incomplete at {}. Trying to get some more".format(prev_t) )
+                self.set_state(ProgressBoard.RETRYING)
+                reconnecting = time.time()
                 result = self.restart_from_last_keyframe()
+                self.trace("reconnect", reconnecting, at = prev_t, failed = result is None)
                 if result is None:
                     # couldn't open stream; fail
                     self.put_message(status = Status.FAIL)
@@ -586,14 +2415,20 @@ class StreamPart:
                 stream, header, mtags, self.offset = result
             
             # finished successfully!
-            self.done = True
-            self.put_message(progress = 1)
-            self.debug_message("Finished at {}".format(prev_t), status = Status.SUCCESS)
+            self.digest = self.checksum.hexdigest()
+            self.report_progress(prev_t, 1)
         finally:
-            stream.close()
+            self.close_stream(stream)
             # remove any trailing data
-            self.outfile.truncate(self.outfile.tell() )
-            self.outfile.close()
+            self.trace("truncate", position = self.outfile.tell() )
+            try:
+                self.outfile.truncate(self.outfile.tell() )
+            finally:
+                self.outfile.close()
+        
+        # only reported once everything has been written
+        self.done = True
+        self.debug_message("Finished at {}".format(prev_t), status = Status.SUCCESS)
 
 #
 #       MultiPart_Downloader:
@@ -604,6 +2439,15 @@ class StreamPart:
 #       you can specify a callback in the connect() method for the 'signals' below.
 #
 class MultiPart_Downloader:
+    # maximum number of seconds to wait before retrying a part
+    MAX_RETRY_DELAY = 60
+    # parts are only hedged once at most this many are left, and only if they are on course
+    # to take this many times as long as the parts that have finished (see hedge_tail())
+    HEDGE_PARTS = 2
+    HEDGE_SLOWDOWN = 1.5
+    # maximum number of debug/info messages from the parts to keep queued (see #MessageQueue)
+    MESSAGE_LIMIT = 1000
+    
     signals = [
         #
         #       ::debug:
@@ -655,9 +2499,17 @@ class MultiPart_Downloader:
         #       @progress:      progress of the download of @part from 0-1
         #       @part:          part
         #       
-        #       Emitted when a part has download progress to report.
+        #       Emitted when a part has download progress to report. The progress of each part
+        #       is looked at every progress_interval seconds (see #ProgressBoard).
         #
             "progress",
+        #
+        #       ::got-digest:
+        #       @digest:        hex SHA-1 of the joined FLV
+        #       
+        #       Emitted when the parts have been joined.
+        #
+            "got-digest",
               ]
     
     #
@@ -670,10 +2522,71 @@ class MultiPart_Downloader:
             self.callbacks[i] = set()
         
         # queue receiving input from threads
-        self.inqueue = Queue.Queue()
+        self.inqueue = MessageQueue(self.MESSAGE_LIMIT)
         # function to construct URL based on seek time
         self.url_fn = lambda t: ""
         self.parts = []
+        # state of the current download; see load_journal()
+        self.journal = None
+        # base filename of the current download
+        self.filename = None
+        # whether self.journal has changed since it was last saved, and when that was
+        self.journal_dirty = False
+        self.journal_time = 0
+        # number of parts of the current download not done yet
+        self.unfinished = 0
+        # runs of adjacent parts waiting for a start time; maps the first part of each
+        # run to the last and vice versa
+        self.runs = {}
+        # number of times each part may be retried
+        self.retries = 0
+        # seconds to wait before the first retry of a part (doubled for each further retry)
+        self.retry_delay = 0
+        # time after which parts are no longer retried (or None)
+        self.deadline = None
+        # whether to write a keyframe index into the joined file
+        self.keyframe_index = True
+        # types of tags to keep
+        self.tag_types = (Tag.AUDIO, Tag.VIDEO)
+        # whether the previous download being resumed had video, as far as its first part tells (see flv_has_video())
+        self.has_video = True
+        # time (in seconds) to start downloading from
+        self.start = 0
+        # timestamp at which the first part really starts (subtracted from all timestamps)
+        self.base = 0
+        # maximum number of bytes to keep in memory for in-memory downloads
+        self.memory_limit = 0
+        # SHA-1 of the joined FLV (hex)
+        self.digest = None
+        # progress of each part of the current download
+        self.board = None
+        # seconds between looking at self.board for progress
+        self.progress_interval = 0.5
+        # time self.board was last looked at, and the progress of each part then
+        self.progress_time = 0
+        self.last_progress = []
+        # #ProbeCache for the parts to use, or None
+        self.cache = None
+        # #OriginPool for the parts to use, or None
+        self.origins = None
+        # function for the parts to open URLs with (see #StreamPart.urlopen)
+        self.urlopen = urllib2.urlopen
+        # #Tracer to record events on (for the parts too), or None
+        self.tracer = None
+        # whether to hedge the last parts, the hedges running for each part, the parts that
+        # have been hedged and when that was last looked at
+        self.hedge = False
+        self.hedges = {}
+        self.hedged = set()
+        # hedges that finished first, for each part, waiting for the other copy to stop (see handle_hedge_message())
+        self.splicing = {}
+        self.hedge_time = 0
+        # seconds each part that has finished took to download
+        self.part_times = []
+        # whether the download has been cancelled (see cancel())
+        self.cancelled = False
+        # whether the download was stopped to be planned again (its plan was out of date)
+        self.replan = False
     
     #
     #   connect:
@@ -682,141 +2595,920 @@ class MultiPart_Downloader:
     #   @args:                  extra arguments to pass to @handler
     #   @kwargs:                extra keyword args to pass to @handler
     #   
-    #   @callback will be called (with extra args in @args and @kwargs) when
-    #   the signal for @signal_name is emitted.
+    #   @callback will be called (with extra args in @args and @kwargs) when
+    #   the signal for @signal_name is emitted.
+    #   
+    #   Returns:                a handler id that can be used in disconnect()
+    #
+    def connect(self, signal_name, callback, *args, **kwargs):
+        callback = functools.partial(callback, *args, **kwargs)
+        self.callbacks[signal_name].add(callback)
+        return callback
+    
+    #
+    #   disconnect:
+    #   @signal_name:           name of signal
+    #   @callback:              callback id obtained from connect()
+    #   
+    #   Disconnect the callback from the signal, so the handler will no longer be called.
+    #
+    def disconnect(self, signal_name, callback):
+        self.callbacks[signal_name].remove(callback)
+    
+    #
+    #   emit:
+    #   @signal_name:           name of signal to emit
+    #   @args:                  args
+    #   @kwargs:                keyword args
+    #   
+    #   'Emit' the signal for @signal_name. The callbacks connected will each be called
+    #   in order. @args and @kwargs are arguments that will be passed to EACH handler.
+    #   The optional 'user_data' args for each handler are only in addition to this.
+    #
+    def emit(self, signal_name, *args, **kwargs):
+        for callback in self.callbacks[signal_name]:
+            callback(*args, **kwargs)
+    
+    #
+    #   trace:
+    #   @event:                 name of the event
+    #   @part:                  part the event belongs to, or None for the downloader itself
+    #   @start:                 time (from time.time()) at which the event started, or None
+    #   @details:               details of the event
+    #   
+    #   Records the event on self.tracer (if any); see #Tracer.event()
+    #
+    def trace(self, event, part = None, start = None, **details):
+        if self.tracer is not None:
+            self.tracer.event(event, part, start, **details)
+    
+    #
+    #   lock_file:
+    #   @name:          name
+    #   
+    #   Creates a lock file based on @name
+    #   Any call to lock_file() with the same @name will then fail (since the lock already exists)
+    #   even from other processes
+    #   
+    #   Returns:        None if failed to create lock file; or file-descriptor on success
+    #
+    def lock_file(self, name):
+        lockname = name + ".lock"
+        try:
+            fd = os.open(lockname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                self.emit("info", "Lock file already exists: " + lockname, None)
+                return None
+        else:
+            # success!
+            self.emit("debug", "Created lock file: " + lockname, None)
+            return fd
+        self.emit("info", "Could not create lock file for some reason: " + lockname, None)
+        return None
+    
+    #
+    #   unlock_file:
+    #   @name:          name
+    #   @fd:            file-descriptor of lock file
+    #   
+    #   Deletes the lock file. Calls to lock_file() can now succeed
+    #
+    def unlock_file(self, name, fd):
+        lockname = name + ".lock"
+        os.remove(lockname)
+        os.close(fd)
+        self.emit("debug", "Lock file removed: " + lockname, None)
+    
+    #
+    #   new_journal:
+    #   @numparts:      total number of parts
+    #   
+    #   Returns:        an empty journal for a download in @numparts parts
+    #
+    def new_journal(self, numparts):
+        parts = [dict(start_time = None, real_offset = None, end_time = None, done = False) for i in range(numparts)]
+        # first part always starts at the start
+        parts[0]["start_time"] = self.start * 1000
+        return dict(stream = stream_key(self.url_fn), numparts = numparts, start = self.start, duration = None,
+                    base = None, filesize = None, tag_types = list(self.tag_types), parts = parts)
+    
+    #
+    #   load_journal:
+    #   @filename:      base filename
+    #   @numparts:      total number of parts
+    #   @duration:      time at which the download ends
+    #   
+    #   Reads the journal left by a previous download to @filename.
+    #   The journal holds the stream (see stream_key()), start, duration (the end time), base, filesize,
+    #   tag types and for each part its start_time, real_offset, end_time and whether it is done
+    #   (and if so, its keyframes and digest).
+    #   
+    #   If the journal is for another stream, start or tag types (or can't be read), the files
+    #   left behind hold something else, so they are set aside (see set_aside()) rather than resumed.
+    #   
+    #   Returns:        the journal, or None if there is none or it doesn't match the current download
+    #                   (then the part files are looked for (see find_part_files()), if they weren't set aside)
+    #
+    def load_journal(self, filename, numparts, duration):
+        journalname = filename + ".journal"
+        try:
+            with open(journalname, "rb") as f:
+                journal = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                self.emit("debug", "Could not read journal {}: {}".format(journalname, e), None)
+            return None
+        except ValueError:
+            self.emit("info", "Journal is corrupt: " + journalname, None)
+            self.set_aside(filename)
+            return None
+        
+        if journal.get("stream") != stream_key(self.url_fn) or journal.get("start") != self.start:
+            self.emit("info", "Journal is for a different download: " + journalname, None)
+            self.set_aside(filename)
+            return None
+        if journal.get("tag_types") != list(self.tag_types):
+            self.emit("info", "Journal is for different tag types: " + journalname, None)
+            self.set_aside(filename)
+            return None
+        
+        # the part files are still those of this download, however it is split up
+        if journal.get("numparts") != numparts:
+            self.emit("info", "Journal is for a different number of parts: " + journalname, None)
+            return None
+        if journal.get("duration") is None:
+            self.emit("debug", "Journal is incomplete: " + journalname, None)
+            return None
+        if duration < journal["duration"]:
+            self.emit("info", "Journal is for a longer duration: " + journalname, None)
+            return None
+        # only usable if every part has been planned
+        for i in journal["parts"]:
+            if None in (i["start_time"], i["real_offset"], i["end_time"]):
+                self.emit("debug", "Journal is incomplete: " + journalname, None)
+                return None
+        self.emit("debug", "Read journal " + journalname, None)
+        return journal
+    
+    #
+    #   save_journal:
+    #   @filename:      base filename
+    #   
+    #   Atomically (re)writes self.journal to @filename.journal
+    #   (no journal is kept if @filename is None)
+    #
+    def save_journal(self, filename):
+        if filename is None:
+            return
+        journalname = filename + ".journal"
+        tmpname = journalname + ".tmp"
+        try:
+            with open(tmpname, "wb") as f:
+                json.dump(self.journal, f)
+                f.flush()
+                os.fsync(f.fileno() )
+            try:
+                os.rename(tmpname, journalname)
+            except OSError:
+                # can't rename over an existing file on Windows
+                os.remove(journalname)
+                os.rename(tmpname, journalname)
+        except (IOError, OSError) as e:
+            self.emit("debug", "Could not write journal {}: {}".format(journalname, e), None)
+    
+    #
+    #   remove_journal:
+    #   @filename:      base filename
+    #
+    def remove_journal(self, filename):
+        if filename is None:
+            return
+        journalname = filename + ".journal"
+        try:
+            os.remove(journalname)
+        except OSError:
+            return
+        self.emit("debug", "Removed journal " + journalname, None)
+    
+    #
+    #   flush_journal:
+    #   @force:         whether to save even if progress_interval hasn't passed since the last save
+    #   
+    #   Saves self.journal to self.filename (see save_journal()) if it has changed.
+    #   Rewriting the whole journal takes time proportional to the number of parts,
+    #   so unless forced it is saved at most once every progress_interval.
+    #
+    def flush_journal(self, force = False):
+        if not self.journal_dirty:
+            return
+        now = time.time()
+        if not force and now - self.journal_time < self.progress_interval:
+            return
+        self.journal_time = now
+        self.journal_dirty = False
+        self.save_journal(self.filename)
+    
+    #
+    #   find_part_files:
+    #   @filename:      base filename
+    #   
+    #   Looks for the part files (@filename.partN) left by a previous download to @filename
+    #   in however many parts, and finds what each of them covers (see flv_range()).
+    #   Part files that can't be resumed, or that overlap the one before them, are skipped
+    #   (and left alone).
     #   
-    #   Returns:                a handler id that can be used in disconnect()
+    #   Returns:        list of (filename, first timestamp, last keyframe timestamp) in the order
+    #                   they are joined in, starting with @filename itself (which covers (0, 0) if
+    #                   there is nothing in it to resume)
     #
-    def connect(self, signal_name, callback, *args, **kwargs):
-        callback = functools.partial(callback, *args, **kwargs)
-        self.callbacks[signal_name].add(callback)
-        return callback
+    def find_part_files(self, filename):
+        directory, name = os.path.split(filename)
+        pattern = re.compile(re.escape(name) + r"\.part\d+$")
+        try:
+            names = [i for i in os.listdir(directory or ".") if pattern.match(i)]
+        except OSError:
+            names = []
+        
+        # keyframes are found as StreamPart.analyse() finds them when resuming
+        has_video = Tag.VIDEO in self.tag_types and flv_has_video(filename)
+        found = []
+        for i in names:
+            part_filename = os.path.join(directory, i)
+            covers = flv_range(part_filename, has_video)
+            if covers is None:
+                self.emit("info", "Nothing to resume in {}; skipping it".format(part_filename), None)
+            else:
+                found.append( (part_filename,) + covers)
+        found.sort(key = lambda i: i[1])
+        
+        covers = flv_range(filename, has_video) or (0, 0)
+        part_files = [(filename,) + covers]
+        for i in found:
+            if i[1] < part_files[-1][2]:
+                self.emit("info", "{} overlaps {}; skipping it".format(i[0], part_files[-1][0]), None)
+            else:
+                part_files.append(i)
+        return part_files
     
     #
-    #   disconnect:
-    #   @signal_name:           name of signal
-    #   @callback:              callback id obtained from connect()
+    #   set_aside:
+    #   @filename:      base filename
     #   
-    #   Disconnect the callback from the signal, so the handler will no longer be called.
+    #   Renames @filename, its part files and its journal (left by some other download to @filename)
+    #   to @name.stale, so that they are neither resumed nor overwritten
     #
-    def disconnect(self, signal_name, callback):
-        self.callbacks[signal_name].remove(callback)
+    def set_aside(self, filename):
+        directory, name = os.path.split(filename)
+        pattern = re.compile(re.escape(name) + r"(\.part\d+|\.journal)?$")
+        try:
+            names = [i for i in os.listdir(directory or ".") if pattern.match(i)]
+        except OSError:
+            names = []
+        for i in names:
+            stale_filename = os.path.join(directory, i)
+            try:
+                if os.path.exists(stale_filename + ".stale"):
+                    # can't rename over an existing file on Windows
+                    os.remove(stale_filename + ".stale")
+                os.rename(stale_filename, stale_filename + ".stale")
+            except OSError as e:
+                self.emit("info", "Could not set aside {}: {}".format(stale_filename, e), None)
+                continue
+            self.emit("info", "Set aside {} as {}".format(stale_filename, stale_filename + ".stale"), None)
     
     #
-    #   emit:
-    #   @signal_name:           name of signal to emit
-    #   @args:                  args
-    #   @kwargs:                keyword args
+    #   layout_parts:
+    #   @filename:      base filename
+    #   @numparts:      total number of parts
+    #   @part_files:    part files to resume (see find_part_files())
+    #   @end:           timestamp at which the download ends
     #   
-    #   'Emit' the signal for @signal_name. The callbacks connected will each be called
-    #   in order. @args and @kwargs are arguments that will be passed to EACH handler.
-    #   The optional 'user_data' args for each handler are only in addition to this.
+    #   Lays out @numparts parts over the download: the parts in @part_files (in order), each followed
+    #   by as many new parts as makes the gaps between them split up as evenly as possible.
+    #   The new parts are given unused part filenames. Sets self.part_files and the files in self.journal.
     #
-    def emit(self, signal_name, *args, **kwargs):
-        for callback in self.callbacks[signal_name]:
-            callback(*args, **kwargs)
+    def layout_parts(self, filename, numparts, part_files, end):
+        # the gap after each part file, up to the next one
+        gaps = [right[1] - left[2] for left, right in zip(part_files, part_files[1:] + [(None, end)])]
+        counts = [0] * len(part_files)
+        # each gap is split between the part file before it and the new parts after that
+        heap = [(-gap, i) for i, gap in enumerate(gaps)]
+        heapq.heapify(heap)
+        for n in range(numparts - len(part_files) ):
+            piece, i = heapq.heappop(heap)
+            counts[i] += 1
+            heapq.heappush(heap, (-float(gaps[i]) / (counts[i] + 1), i) )
+        
+        number = 0
+        self.part_files = []
+        for part_file, count in zip(part_files, counts):
+            self.part_files.append(part_file[0])
+            for n in range(count):
+                number += 1
+                while os.path.exists("{}.part{}".format(filename, number) ):
+                    number += 1
+                self.part_files.append("{}.part{}".format(filename, number) )
+        for plan, part_filename in zip(self.journal["parts"], self.part_files):
+            plan["file"] = part_filename
+        self.emit("debug", "Laid out parts: " + ", ".join(self.part_files), None)
     
     #
-    #   lock_file:
-    #   @name:          name
+    #   plan_from_cache:
+    #   @numparts:      total number of parts
+    #   @duration:      time at which the download ends
     #   
-    #   Creates a lock file based on @name
-    #   Any call to lock_file() with the same @name will then fail (since the lock already exists)
-    #   even from other processes
+    #   Plans the download the same way the parts would (see save_stream()), but from what
+    #   self.cache knows about where the stream starts for each seek time.
     #   
-    #   Returns:        None if failed to create lock file; or file-descriptor on success
+    #   Returns:        a journal (see load_journal()) with every part planned,
+    #                   or None if self.cache doesn't know enough
     #
-    def lock_file(self, name):
-        lockname = name + ".lock"
-        try:
-            fd = os.open(lockname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
-        except OSError as e:
-            if e.errno == errno.EEXIST:
-                self.emit("info", "Lock file already exists: " + lockname, None)
+    def plan_from_cache(self, numparts, duration):
+        key = stream_key(self.url_fn)
+        stream = self.cache.get_stream(key)
+        if stream is None:
+            return None
+        header, metadata, full_duration = stream
+        base = self.cache.get_seek(key, self.start * 1000)
+        if base is None:
+            return None
+        duration = min(full_duration, duration)
+        
+        journal = self.new_journal(numparts)
+        parts = journal["parts"]
+        parts[0]["real_offset"] = base
+        part_duration = float(duration * 1000 - parts[0]["start_time"]) / numparts
+        for i in range(1, numparts):
+            parts[i]["start_time"] = parts[0]["start_time"] + i * part_duration
+            parts[i]["real_offset"] = self.cache.get_seek(key, parts[i]["start_time"])
+            if parts[i]["real_offset"] is None or not parts[i - 1]["real_offset"] < parts[i]["real_offset"] < duration * 1000:
                 return None
-        else:
-            # success!
-            self.emit("debug", "Created lock file: " + lockname, None)
-            return fd
-        self.emit("info", "Could not create lock file for some reason: " + lockname, None)
-        return None
+            # offset of part X is end time of part X-1
+            parts[i - 1]["end_time"] = parts[i]["real_offset"]
+        parts[-1]["end_time"] = duration * 1000
+        
+        journal["duration"] = duration
+        journal["base"] = int(round(base) )
+        filesize = Tag(Tag.METADATA, 0, metadata[0][11:-4], metadata[0]).get_metadata_number("filesize")
+        clip_duration = duration - journal["base"] / 1000.0
+        if filesize is not None and clip_duration < full_duration:
+            # only part of the video is wanted
+            filesize *= clip_duration / full_duration
+        journal["filesize"] = filesize
+        return journal
     
     #
-    #   unlock_file:
-    #   @name:          name
-    #   @fd:            file-descriptor of lock file
+    #   probe:
+    #   @times:         dictionary of the time (in msecs) to open the stream at for each part
+    #   @numparts:      total number of parts
     #   
-    #   Deletes the lock file. Calls to lock_file() can now succeed
+    #   Opens the stream at each of @times at once, reading just the header and metadata
+    #   to find out where it really starts (which is added to self.cache), and closes it again.
+    #   
+    #   Returns:        dictionary of the result of #StreamPart.open_stream() for each part
     #
-    def unlock_file(self, name, fd):
-        lockname = name + ".lock"
-        os.remove(lockname)
-        os.close(fd)
-        self.emit("debug", "Lock file removed: " + lockname, None)
+    def probe(self, times, numparts):
+        outqueue = MessageQueue(self.MESSAGE_LIMIT)
+        results = {}
+        def run(part):
+            sp = StreamPart(Queue.Queue(), outqueue, part, None, self.url_fn, numparts)
+            sp.cache = self.cache
+            sp.origins = self.origins
+            sp.urlopen = self.urlopen
+            sp.tracer = self.tracer
+            results[part] = sp.open_stream(start = times[part])
+            if results[part] is not None:
+                sp.close_stream(results[part][0])
+        
+        threads = [Thread(target = run, args = (part,), name = "part {} probe".format(part) ) for part in times]
+        for i in threads:
+            i.daemon = True
+            i.start()
+        for i in threads:
+            i.join()
+        # pass on the probes' messages
+        while not outqueue.empty():
+            self.wait_for_message(outqueue)
+        return results
+    
+    #
+    #   preflight:
+    #   @numparts:      total number of parts
+    #   @duration:      time at which the download ends
+    #   
+    #   Probes (see probe()) where the stream starts at the start time of each part, if
+    #   not already in self.cache, so that the download can be planned with plan_from_cache().
+    #   The first part is probed first (to find the duration), then all the others at once.
+    #   
+    #   Returns:        the plan (see plan_from_cache()), or None if the probes failed
+    #
+    def preflight(self, numparts, duration):
+        key = stream_key(self.url_fn)
+        start_time = self.start * 1000
+        if self.cache.get_stream(key) is None or self.cache.get_seek(key, start_time) is None:
+            result = self.probe({0 : start_time}, numparts)[0]
+            if result is None:
+                return None
+            stream, header, mtags, offset = result
+            full_duration = mtags[0].get_metadata_number("duration")
+            if full_duration is None:
+                self.emit("info", "Metadata missing duration key", 0)
+                return None
+            self.cache.add_stream(key, header, mtags, full_duration)
+        
+        # the same start times as the parts would get
+        full_duration = self.cache.get_stream(key)[2]
+        part_duration = float(min(full_duration, duration) * 1000 - start_time) / numparts
+        times = {}
+        for i in range(1, numparts):
+            if self.cache.get_seek(key, start_time + i * part_duration) is None:
+                times[i] = start_time + i * part_duration
+        if times:
+            self.emit("debug", "Probing start of parts {}".format(sorted(times) ), None)
+            if None in self.probe(times, numparts).values():
+                return None
+        
+        plan = self.plan_from_cache(numparts, duration)
+        if plan is None:
+            self.emit("info", "Parts would overlap; not using probes", None)
+        return plan
     
     #
     #   start_part_thread:
     #   @part:                  part
     #   @filename:              base filename
     #   @numparts:              total number of parts
+    #   @no_resume:             don't resume previous downloads
+    #   @filesize:              estimated size of the whole video (for preallocation), or None
+    #   @plan:                  journal entry for this part from a previous download, or None
+    #   @previous:              #StreamPart for @part that failed, or None
     #   
     #   Start the downloading of the part @part in a separate thread.
     #   If @part==0, the filename is @filename, otherwise it is @filename.part3 for example, if @part==3
+    #   If @filename is None, the part is downloaded into a #MemoryFile instead.
+    #   
+    #   If @plan is given, the part starts and ends where it did before. If @plan says
+    #   the part is done (and its file exists), no thread is started at all.
+    #   
+    #   If @previous is given, the new part replaces it and carries on from where it left off.
     #
-    def start_part_thread(self, part, filename, numparts, no_resume):
+    def start_part_thread(self, part, filename, numparts, no_resume, filesize = None, plan = None, previous = None):
         outqueue = Queue.Queue()
-        if part == 0:
-            part_filename = filename
-        else:
-            part_filename = "{}.part{}".format(filename, part)
+        part_filename = self.part_files[part]
         
-        # open the file
-        try:
-            outfile = open(part_filename, "r+b")
-            resumable = not no_resume
-        except IOError as e:
-            if e.errno == 2:
-                # file does not exist; can't resume
-                outfile = open(part_filename, "wb")
-                resumable = False
+        if plan is not None and plan["done"] and os.path.exists(part_filename):
+            # finished in a previous download; nothing to do
+            sp = StreamPart(outqueue, self.inqueue, part, None, self.url_fn, numparts, filesize)
+            sp.start_time = plan["start_time"]
+            sp.real_offset = plan["real_offset"]
+            sp.end_time = plan["end_time"]
+            # keyframes are needed for the index
+            if plan.get("keyframes") is None:
+                sp.keyframes = None
             else:
-                self.emit("debug", "Failed to create file: {}".format(e) )
-                return False
+                sp.keyframes = dict( (t, pos) for t, pos in plan["keyframes"] )
+            sp.digest = plan.get("digest")
+            sp.need_start = sp.need_end = False
+            sp.done = True
+            self.board.put(part, bytes = os.path.getsize(part_filename), progress = 1, state = ProgressBoard.DONE)
+            self.parts.append(sp)
+            self.unfinished -= 1
+            self.emit("debug", "Already finished " + part_filename, part)
+            self.emit("part-finished", part)
+            return True
         
-        self.emit("debug", "Created file " + part_filename, None)
-        sp = StreamPart(outqueue, self.inqueue, part, outfile, self.url_fn, numparts)
-        self.parts.append(sp)
-        # start the thread
-        sp.thread = Thread(target = sp.save_stream_part, kwargs = dict(resume = resumable) )
+        if filename is None:
+            # in-memory download; nothing to resume
+            if previous is not None:
+                outfile = previous.outfile
+            else:
+                outfile = MemoryFile(self.memory_limit // numparts)
+                self.emit("debug", "Created buffer for part {}".format(part), None)
+            resumable = False
+        else:
+            # open the file
+            try:
+                outfile = open(part_filename, "r+b")
+                # no need to analyse the file if carrying on from @previous
+                resumable = not no_resume and previous is None
+            except IOError as e:
+                if e.errno == 2:
+                    # file does not exist; can't resume
+                    outfile = open(part_filename, "wb")
+                    resumable = False
+                else:
+                    self.emit("debug", "Failed to create file: {}".format(e) )
+                    return False
+            self.emit("debug", "Created file " + part_filename, None)
+        sp = StreamPart(outqueue, self.inqueue, part, outfile, self.url_fn, numparts, filesize)
+        if plan is not None:
+            sp.start_time = plan["start_time"]
+            sp.end_time = plan["end_time"]
+            sp.planned_offset = plan["real_offset"]
+        sp.reserve_index = self.keyframe_index
+        sp.tag_types = self.tag_types
+        sp.has_video = self.has_video
+        sp.base = self.base
+        sp.board = self.board
+        sp.cache = self.cache
+        sp.origins = self.origins
+        sp.urlopen = self.urlopen
+        sp.tracer = self.tracer
+        if part == 0 and plan is None:
+            sp.start_time = self.start * 1000
+        if previous is not None:
+            sp.take_over(previous)
+            sp.delay = min(self.retry_delay * 2 ** previous.retries, self.MAX_RETRY_DELAY)
+            self.parts[part] = sp
+        else:
+            self.parts.append(sp)
+        # start the thread (named after the part, so that it can be told apart, e.g. by faults.py)
+        sp.thread = Thread(target = sp.save_stream_part, kwargs = dict(resume = resumable), name = "part {}".format(part) )
         sp.thread.daemon = True
         sp.thread.start()
         return True
     
+    #
+    #   retry_part:
+    #   @part:                  part that failed
+    #   @filename:              base filename
+    #   @numparts:              total number of parts
+    #   
+    #   Restarts the failed part @part (after a delay that doubles with each retry) from
+    #   its last keyframe, unless it has been retried too many times or the deadline has passed.
+    #   
+    #   Returns:                True iff @part was restarted
+    #
+    def retry_part(self, part, filename, numparts):
+        previous = self.parts[part]
+        if previous.retries >= self.retries:
+            self.emit("info", "Part {} has failed too many times".format(part), None)
+            return False
+        if self.deadline is not None and time.time() > self.deadline:
+            self.emit("info", "Deadline passed; not retrying part {}".format(part), None)
+            return False
+        
+        # wait for the old thread to close its file
+        previous.thread.join()
+        if not self.start_part_thread(part, filename, numparts, True, previous = previous):
+            return False
+        self.emit("info", "Retrying part {} in {} secs (retry {} of {})".format(
+            part, self.parts[part].delay, previous.retries + 1, self.retries), None)
+        self.trace("retry", to = part, delay = self.parts[part].delay, retry = previous.retries + 1)
+        return True
+    
     #
     #   stop_all_parts:
     #   
     #   Tell each of the #StreamPart to stop; then wait for them to finish
     #
     def stop_all_parts(self):
+        self.stop_hedges()
         for i in self.parts:
             i.inqueue.put(Status.FAIL)
         for i in self.parts:
             if i.thread is not None:
                 i.thread.join()
-            i.outfile.close()
+            if i.outfile is not None:
+                i.outfile.close()
+    
+    #
+    #   hedge_tail:
+    #   
+    #   Once at most HEDGE_PARTS parts are left, starts a hedge (see start_hedge()) of each of them
+    #   that is behind, i.e. on course to take more than HEDGE_SLOWDOWN times as long as the parts
+    #   that have finished usually took. Each part is hedged once at most, and not until it has
+    #   a keyframe to hedge from.
+    #   Looked at no more than once every progress_interval.
+    #
+    def hedge_tail(self):
+        if not self.hedge or not self.part_times or self.unfinished > self.HEDGE_PARTS:
+            return
+        now = time.time()
+        if now - self.hedge_time < self.progress_interval:
+            return
+        self.hedge_time = now
+        expected = sorted(self.part_times)[len(self.part_times) // 2]
+        for p in self.parts:
+            if p.done or p.part in self.hedged or p.downloading_since is None or not p.keyframes:
+                continue
+            # projected to take (time so far) / progress
+            if now - p.downloading_since > self.HEDGE_SLOWDOWN * expected * self.board.get(p.part).progress:
+                if self.start_hedge(p.part):
+                    self.hedged.add(p.part)
+    
+    #
+    #   start_hedge:
+    #   @part:              part
+    #   
+    #   Starts a hedge of @part from its latest keyframe: a second copy of it, on a new connection,
+    #   writing to @part's file + ".hedge" (or into memory). Whichever copy finishes first is kept
+    #   (see handle_hedge_message()).
+    #   
+    #   Returns:            True iff the hedge was started
+    #
+    def start_hedge(self, part):
+        previous = self.parts[part]
+        # (the part is still adding to its keyframes)
+        keyframes = dict(previous.keyframes)
+        if not keyframes:
+            return False
+        keyframe = max(keyframes)
+        if self.filename is None:
+            outfile = MemoryFile(self.memory_limit // len(self.parts) )
+        else:
+            try:
+                outfile = open(self.part_files[part] + ".hedge", "w+b")
+            except IOError as e:
+                self.emit("debug", "Failed to create file: {}".format(e), None)
+                return False
+        sp = StreamPart(Queue.Queue(), self.inqueue, part, outfile, self.url_fn, len(self.parts) )
+        sp.hedge_from(previous, keyframe)
+        sp.tag_types = self.tag_types
+        sp.cache = self.cache
+        sp.origins = self.origins
+        sp.urlopen = self.urlopen
+        sp.tracer = self.tracer
+        self.hedges[part] = sp
+        self.emit("info", "Part {} is behind; hedging it from {}".format(part, keyframe), None)
+        self.trace("hedge", to = part, keyframe = keyframe)
+        sp.thread = Thread(target = sp.save_stream_part, name = "part {} hedge".format(part) )
+        sp.thread.daemon = True
+        sp.thread.start()
+        return True
+    
+    #
+    #   splice_hedge:
+    #   @part:              part
+    #   @hedge:             hedge of @part that finished first
+    #   
+    #   Replaces whatever the other copy of @part wrote after the keyframe @hedge started from
+    #   with what @hedge wrote, and puts @hedge in its place.
+    #
+    def splice_hedge(self, part, hedge):
+        previous = self.parts[part]
+        position = hedge.hedge_position
+        if self.filename is None:
+            src = hedge.outfile
+            dst = previous.outfile
+        else:
+            src = open(self.part_files[part] + ".hedge", "rb")
+            dst = open(self.part_files[part], "r+b")
+        try:
+            src.seek(position, 0)
+            dst.seek(position, 0)
+            dst.truncate(position)
+            shutil.copyfileobj(src, dst)
+        finally:
+            if self.filename is not None:
+                src.close()
+                dst.close()
+        self.discard_hedge(hedge)
+        
+        keyframes = dict( (t, pos) for t, pos in previous.keyframes.items() if pos < position)
+        keyframes.update(hedge.keyframes)
+        hedge.keyframes = keyframes
+        hedge.outfile = previous.outfile
+        self.parts[part] = hedge
+    
+    #
+    #   discard_hedge:
+    #   @hedge:             hedge that has stopped
+    #   
+    #   Removes the file @hedge wrote to (if any)
+    #
+    def discard_hedge(self, hedge):
+        if self.filename is None:
+            return
+        try:
+            os.remove(self.part_files[hedge.part] + ".hedge")
+        except OSError:
+            pass
+    
+    #
+    #   stop_hedges:
+    #   
+    #   Tells each hedge still running to stop; then waits for them and discards them
+    #
+    def stop_hedges(self):
+        hedges = self.hedges.values()
+        self.hedges = {}
+        for i in hedges:
+            i.inqueue.put(Status.FAIL)
+        for i in hedges:
+            i.thread.join()
+            self.discard_hedge(i)
+        # (these have stopped already)
+        for i in self.splicing.values():
+            self.discard_hedge(i)
+        self.splicing = {}
+    
+    #
+    #   write_keyframe_index:
+    #   @f:                 the joined FLV (file object)
+    #   @sizes:             list of the sizes of each part (before joining)
+    #   @duration:          duration of the joined FLV
+    #   
+    #   Rewrites the onMetaData tag at the start of @f in place with the correct
+    #   filesize and duration and an index of the keyframes of all parts.
+    #   This only works if the first part reserved room for it (see #StreamPart.reserve_index).
+    #   
+    #   Returns:            True iff the index was written
+    #
+    def write_keyframe_index(self, f, sizes, duration):
+        times = []
+        positions = []
+        base = 0
+        for p, size in zip(self.parts, sizes):
+            if p.keyframes is None:
+                self.emit("info", "Keyframes unknown; not writing keyframe index", p.part)
+                return
+            for t, pos in sorted(p.keyframes.items() ):
+                # ignore keyframes that were truncated away
+                if pos >= size:
+                    continue
+                t = (t - self.base) / 1000.0
+                # no more than room was reserved for (see StreamPart.reserve_index_metadata())
+                if times and int(t * StreamPart.INDEX_KEYFRAMES_PER_SEC) == int(times[-1] * StreamPart.INDEX_KEYFRAMES_PER_SEC):
+                    continue
+                times.append(t)
+                positions.append(base + pos)
+            base += size
+        
+        # metadata tag is just after header
+        f.seek(13, 0)
+        tag = self.parts[0].get_next_tag(f)
+        if tag is None or tag._type != Tag.METADATA:
+            self.emit("info", "Missing metadata; not writing keyframe index", None)
+            return
+        
+        try:
+            keys = [key for key, value in read_metadata(tag.body)[1]]
+            body = None
+            if INDEX_PADDING_KEY in keys:
+                body = index_metadata(tag.body, times, positions, dict(filesize = base, duration = duration), len(tag.body) )
+        except ValueError as e:
+            self.emit("info", "Can't read metadata; not writing keyframe index: {}".format(e), None)
+            return
+        if body is None:
+            self.emit("info", "Not enough room for keyframe index", None)
+            return
+        
+        # overwrite the body of the metadata tag
+        f.seek(13 + 11, 0)
+        f.write(body)
+        self.emit("debug", "Wrote keyframe index ({} keyframes)".format(len(times) ), None)
+        return True
+    
+    #
+    #   write_metadata:
+    #   @f:                 the joined FLV (file object)
+    #   @sizes:             list of the sizes of each part (before joining)
+    #   @duration:          duration of the joined FLV
+    #   
+    #   Rewrites the onMetaData tag at the start of @f in place with the correct filesize and
+    #   duration: along with a keyframe index (see write_keyframe_index()) unless there is to be
+    #   none or there is no room for it, in which case only the values already there are changed
+    #   (e.g. so that a clip doesn't claim to be as long as the whole video).
+    #
+    def write_metadata(self, f, sizes, duration):
+        if self.keyframe_index:
+            indexing = time.time()
+            written = self.write_keyframe_index(f, sizes, duration)
+            self.trace("keyframe-index", None, indexing)
+            if written:
+                return
+        
+        f.seek(13, 0)
+        tag = self.parts[0].get_next_tag(f)
+        if tag is None or tag._type != Tag.METADATA:
+            self.emit("info", "Missing metadata; not updating duration", None)
+            return
+        try:
+            body = update_metadata(tag.body, dict(filesize = sum(sizes), duration = duration) )
+        except ValueError as e:
+            self.emit("info", "Can't read metadata; not updating duration: {}".format(e), None)
+            return
+        if body is None:
+            self.emit("info", "Can't update duration in place", None)
+            return
+        f.seek(13 + 11, 0)
+        f.write(body)
+        self.emit("debug", "Updated filesize and duration", None)
+    
+    #
+    #   join_part:
+    #   @p:                 #StreamPart
+    #   @src:               file object holding @p, positioned at its start
+    #   @dst:               file object to append @p to, or None if @src is the start of the joined FLV
+    #   @digest:            SHA-1 of the joined FLV up to @p, to update with @p
+    #   
+    #   Copies @p and hashes it on the way. Its data is also checked against the checksum kept
+    #   while it was downloaded (which doesn't cover the header and metadata of the first part),
+    #   in case it changed since.
+    #   
+    #   Returns:            size of @p
+    #
+    def join_part(self, p, src, dst, digest):
+        size = 0
+        if p.part == 0:
+            src.seek(13, 0)
+            for i in range(2):
+                p.get_next_tag(src)
+            size = src.tell()
+            src.seek(0, 0)
+            digest.update(src.read(size) )
+        part_digest = hashlib.sha1()
+        size += copy_hashed(src, dst, [digest, part_digest])
+        if p.digest is not None and part_digest.hexdigest() != p.digest:
+            self.emit("info", "Part doesn't match its checksum; it changed since it was downloaded", p.part)
+        return size
+    
+    #
+    #   join_memory_parts:
+    #   @duration:          duration of the joined FLV
+    #   
+    #   Joins the #MemoryFile of each part (the first one is appended to).
+    #   Each part is freed once it has been appended. The joined FLV may only take up the memory
+    #   (out of self.memory_limit bytes) the parts not appended yet don't, otherwise it is moved to
+    #   a temporary file; so no more than self.memory_limit bytes are kept in memory in all.
+    #   
+    #   Returns:            the joined FLV as a file object, positioned at the start
+    #
+    def join_memory_parts(self, duration):
+        sizes = []
+        for p in self.parts:
+            p.outfile.seek(0, 2)
+            sizes.append(p.outfile.tell() )
+        # bytes the parts not appended yet keep in memory
+        held = sum(size for p, size in zip(self.parts[1:], sizes[1:]) if p.outfile.in_memory)
+        
+        # the metadata is written first, so that the digest can be worked out while joining
+        ofile = self.parts[0].outfile
+        self.write_metadata(ofile, sizes, duration)
+        digest = hashlib.sha1()
+        ofile.seek(0, 0)
+        self.join_part(self.parts[0], ofile, None, digest)
+        for p, size in zip(self.parts[1:], sizes[1:]):
+            joining = time.time()
+            # (this part is still in memory while it is being copied)
+            ofile.limit = self.memory_limit - held
+            p.outfile.seek(0, 0)
+            self.join_part(p, p.outfile, ofile, digest)
+            if p.outfile.in_memory:
+                held -= size
+            # free the memory
+            p.outfile = None
+            self.trace("join", p.part, joining, size = size)
+            self.emit("debug", "Appended part {}".format(p.part), None)
+        
+        self.digest = digest.hexdigest()
+        self.trace("joined", digest = self.digest)
+        self.emit("info", "Joining done", None)
+        self.emit("got-digest", self.digest)
+        ofile.seek(0, 0)
+        return ofile.fileobj
+    
+    #
+    #   emit_progress:
+    #   @force:             whether to look at self.board even if progress_interval hasn't passed
+    #   
+    #   Emits "progress" for each part that has progressed since self.board was last looked at
+    #
+    def emit_progress(self, force = False):
+        now = time.time()
+        if not force and now - self.progress_time < self.progress_interval:
+            return
+        self.progress_time = now
+        for part in range(self.board.numparts):
+            progress = self.board.get(part).progress
+            if progress != self.last_progress[part]:
+                self.last_progress[part] = progress
+                self.emit("progress", progress, part)
     
     #
     #   wait_for_message:
     #   @queue:             queue
     #   
     #   Convenience function.
-    #   Gets messages from @queue, performs default actions on "debug" and "info"
+    #   Gets messages from @queue (a #MessageQueue), performs default actions on "debug" and "info"
     #   messages and returns whatever is left.
+    #   Progress is emitted (see emit_progress()), the journal saved (see flush_journal())
+    #   and the last parts hedged (see hedge_tail()) while waiting.
     #   
     #   Returns:            part, message, status
     #
     def wait_for_message(self, queue):
-        message = queue.get()
+        while True:
+            self.emit_progress()
+            self.flush_journal()
+            self.hedge_tail()
+            try:
+                message = queue.get(timeout = self.progress_interval)
+                break
+            except Queue.Empty:
+                pass
         part = message.pop("part")
         
         if "debug" in message:
@@ -827,17 +3519,283 @@ class MultiPart_Downloader:
         status = message.pop("status", None)
         return part, message, status
     
+    #
+    #   start_run:
+    #   @left:              first part of a run of parts waiting for a start time
+    #   @right:             last part of the run
+    #   @duration:          time at which the download ends
+    #   
+    #   Once the parts on either side of the run know where they start, splits the time
+    #   between them evenly and sends each part of the run its start time.
+    #
+    def start_run(self, left, right, duration):
+        numparts = len(self.parts)
+        if left > 0 and self.parts[left - 1].need_start is not False:
+            return
+        if right < numparts - 1 and self.parts[right + 1].need_start is not False:
+            return
+        del self.runs[left]
+        self.runs.pop(right, None)
+        
+        if left == 0:
+            left_time = 0
+        else:
+            left_time = self.parts[left - 1].start_time
+        
+        if right == numparts - 1:
+            right_time = duration * 1000
+        else:
+            right_time = self.parts[right + 1].real_offset
+        
+        part_duration = float(right_time - left_time) / (right - left + 2)
+        self.trace("start-times", to = [left, right], left_time = left_time, right_time = right_time)
+        # send a start time to each of them
+        for index in range(left, right + 1):
+            start_time = left_time + (index - left + 1) * part_duration
+            self.parts[index].inqueue.put(start_time)
+            self.parts[index].need_start = False
+            self.journal["parts"][index]["start_time"] = start_time
+        self.journal_dirty = True
+    
+    #
+    #   send_end_time:
+    #   @part:              part
+    #   @duration:          time at which the download ends
+    #   
+    #   Sends @part its end time if it is waiting for one and the next part
+    #   knows where it really starts.
+    #
+    def send_end_time(self, part, duration):
+        if not self.parts[part].need_end:
+            return
+        if part == len(self.parts) - 1:
+            # last part should end at most at duration
+            end_time = duration * 1000
+        elif self.parts[part + 1].need_end is None:
+            return
+        else:
+            # offset of part X is end time of part X-1
+            end_time = self.parts[part + 1].real_offset
+        self.trace("end-time", to = part, end_time = end_time)
+        self.parts[part].inqueue.put(end_time)
+        self.parts[part].need_end = False
+        self.journal["parts"][part]["end_time"] = end_time
+        self.journal_dirty = True
+    
+    #
+    #   handle_message:
+    #   @part:              part the message is from
+    #   @message:           the message (see wait_for_message())
+    #   @status:            status in the message, or None
+    #   @duration:          time at which the download ends
+    #   
+    #   Acts on a message from a part once all parts have been started.
+    #   Only the part itself and its neighbours are looked at (each part is sent its start time
+    #   once at most), so this takes constant time however many parts there are.
+    #   
+    #   Returns:            False if a part failed and the download has to be aborted
+    #                       (or, with self.replan set, planned again), otherwise True
+    #
+    def handle_message(self, part, message, status, duration):
+        if message.get("hedge"):
+            return self.handle_hedge_message(part, status)
+        if part in self.splicing:
+            # the other copy of a part whose hedge finished first
+            if status is None or not self.splice_stopped(part, status):
+                return True
+        elif status == Status.FAIL and self.parts[part].done:
+            # (a part that has finished has nothing more to say)
+            return True
+        
+        if status is not None:
+            if message.get("stale"):
+                # planned from out-of-date probes; stop and plan from scratch
+                if self.cache is not None:
+                    self.cache.forget(stream_key(self.url_fn) )
+                self.journal_dirty = False
+                self.remove_journal(self.filename)
+                self.emit("info", "Part {} was planned from out-of-date information. Planning again".format(part), None)
+                self.trace("replan", failed = part)
+                self.stop_all_parts()
+                self.replan = True
+                return False
+            # if this part failed and can't be retried, abort all
+            if status == Status.FAIL and not self.retry_part(part, self.filename, len(self.parts) ):
+                self.emit("part-failed", part)
+                self.emit("info", "Part {} failed. Stopping all parts".format(part), None)
+                self.trace("abort", failed = part)
+                self.flush_journal(force = True)
+                self.stop_all_parts()
+                return False
+            
+            # this part is done
+            if status == Status.SUCCESS:
+                self.finish_part(part)
+        
+        if "need_start" in message:
+            # this part has figured out if it needs start_time
+            plan = self.journal["parts"][part]
+            if not message["need_start"] and plan["start_time"] is None:
+                # where this part would start if it had to be downloaded again
+                p = self.parts[part]
+                plan["start_time"] = p.start_time if p.real_offset is None else p.real_offset
+                self.journal_dirty = True
+            
+            if message["need_start"]:
+                # join up with the runs of parts waiting on either side
+                left = self.runs.pop(part - 1, part)
+                right = self.runs.pop(part + 1, part)
+                self.runs[left] = right
+                self.runs[right] = left
+                self.start_run(left, right, duration)
+            else:
+                # the runs on either side may be able to start now
+                if part - 1 in self.runs:
+                    self.start_run(self.runs[part - 1], part - 1, duration)
+                if part + 1 in self.runs:
+                    self.start_run(part + 1, self.runs[part + 1], duration)
+        
+        if "need_end" in message:
+            # this part has figured out if it needs end_time (and knows its real offset)
+            self.journal["parts"][part]["real_offset"] = self.parts[part].real_offset
+            self.journal_dirty = True
+            if part > 0:
+                self.send_end_time(part - 1, duration)
+            self.send_end_time(part, duration)
+        return True
+    
+    #
+    #   cancel:
+    #   
+    #   Stops the download in save_stream() (which may be running in another thread) as soon as
+    #   it is next woken up. What has been downloaded is kept, so the download can be resumed.
+    #   If save_stream() hasn't started yet, it stops as soon as it hears from a part.
+    #
+    def cancel(self):
+        self.cancelled = True
+        # wake save_stream() up
+        self.inqueue.put(dict(part = None) )
+    
+    #
+    #   stop_cancelled:
+    #   
+    #   Saves the journal and stops all parts, once the download has been cancelled
+    #
+    def stop_cancelled(self):
+        self.emit("info", "Download cancelled. Stopping all parts", None)
+        self.trace("abort", cancelled = True)
+        self.flush_journal(force = True)
+        self.stop_all_parts()
+    
+    #
+    #   finish_part:
+    #   @part:              part that has finished
+    #   
+    #   Records @part as done (in self.journal too) and stops its hedge, if any
+    #
+    def finish_part(self, part):
+        p = self.parts[part]
+        self.unfinished -= 1
+        self.emit("part-finished", part)
+        if p.downloading_since is not None and not p.hedge:
+            self.part_times.append(time.time() - p.downloading_since)
+        self.journal["parts"][part]["done"] = True
+        self.journal["parts"][part]["keyframes"] = sorted(p.keyframes.items() )
+        self.journal["parts"][part]["digest"] = p.digest
+        self.journal_dirty = True
+        if part in self.hedges:
+            # the hedge has lost; it is discarded once it stops (see handle_hedge_message())
+            self.hedges[part].inqueue.put(Status.FAIL)
+    
+    #
+    #   handle_hedge_message:
+    #   @part:              part the message is from a hedge of
+    #   @status:            status in the message, or None
+    #   
+    #   Once the hedge of @part has stopped, discards it unless it finished before the other copy
+    #   of @part. If it did, the other copy is told to stop (see #StreamPart.abort()) and the hedge
+    #   is kept in self.splicing until the other copy says it has (see splice_stopped()), so that
+    #   a copy stuck on a stalled connection doesn't hold up the other parts.
+    #   
+    #   Returns:            True
+    #
+    def handle_hedge_message(self, part, status):
+        if status is None:
+            # hedges know their start and end times already
+            return True
+        hedge = self.hedges.pop(part)
+        hedge.thread.join()
+        if status != Status.SUCCESS or self.parts[part].done:
+            self.trace("hedged", part, won = False)
+            self.discard_hedge(hedge)
+            return True
+        # stop the other copy (which may yet finish first)
+        self.splicing[part] = hedge
+        self.parts[part].abort()
+        return True
+    
+    #
+    #   splice_stopped:
+    #   @part:              part whose hedge finished first (see handle_hedge_message())
+    #   @status:            status the other copy of @part stopped with
+    #   
+    #   Keeps the hedge of @part in place of the other copy (see splice_hedge()), unless the
+    #   other copy finished after all.
+    #   
+    #   Returns:            False if the hedge was kept (so @status is dealt with),
+    #                       True if the other copy is to be handled like any other part
+    #
+    def splice_stopped(self, part, status):
+        hedge = self.splicing.pop(part)
+        previous = self.parts[part]
+        # it has nothing left to do but close its file
+        previous.thread.join()
+        won = status != Status.SUCCESS
+        self.trace("hedged", part, won = won)
+        if not won:
+            self.discard_hedge(hedge)
+            return True
+        self.splice_hedge(part, hedge)
+        # the other copy has marked the part as failed
+        self.board.put(part, progress = 1, state = ProgressBoard.DONE)
+        self.emit("info", "Hedge of part {} finished first".format(part), None)
+        self.finish_part(part)
+        return False
+    
     #
     #   save_stream:
-    #   @url_fn:        function that returns a URL for a given seek-time
+    #   @url_fn:        function that returns a URL for a given seek-time, or a list of them
+    #                   for different origins of the same stream (see #OriginPool)
     #   @filename:      filename to save FLV to
     #   @numparts:      number of parts in which to download FLV
-    #   @duration:      total duration of FLV to download
+    #   @duration:      duration of FLV to download (from @start)
     #   @no_resume:     don't resume previous downloads
     #   @lock:          use lock file
+    #   @no_index:      don't write a keyframe index into the joined file
+    #   @tag_types:     types of tags to keep: (Tag.AUDIO, Tag.VIDEO), (Tag.AUDIO,) or (Tag.VIDEO,)
+    #   @memory_limit:  maximum number of bytes to keep in memory (for all parts, and when joining them)
+    #                   if @filename is None
+    #   @retries:       number of times each part may be retried if it fails
+    #   @retry_delay:   seconds to wait before retrying a part (doubled for each further retry)
+    #   @deadline:      seconds after which failed parts are no longer retried (or None)
+    #   @start:         time (in seconds) to start downloading from
+    #   @progress_file: file to keep the #ProgressBoard in (so other processes can open it), or None
+    #   @progress_interval: seconds between emitting "progress"
+    #   @probe_cache:   #ProbeCache to plan the download from (and to save what is found out to)
+    #   @preflight:     whether to probe the start of each part before downloading (see preflight())
+    #   @tracer:        #Tracer to record what the parts and the downloader do on, or None
+    #   @hedge:         whether to race a second copy of the last parts if they fall behind (see hedge_tail())
     #
     #   Downloads the FLV stream from @url_fn in several parts and save to @filename.
-    #   Specify @duration if not downloading full video.
+    #   Specify @start and/or @duration if not downloading full video. The first part starts
+    #   at the keyframe at (or before) @start and the saved timestamps are shifted to start at 0.
+    #   The whole stream is still downloaded, but only tags in @tag_types are saved.
+    #   If @url_fn is a list of origins, each stream (including reconnects and retries) is
+    #   opened from whichever origin is doing best at the time.
+    #   
+    #   If @filename is None, the parts are downloaded into memory instead (without resuming
+    #   or locking) and the joined FLV is returned as a file object (positioned at the start).
+    #   If it grows past @memory_limit bytes, it is moved to a temporary file.
     #
     #   This is the ONLY function that will emit signals.
     #   
@@ -845,16 +3803,47 @@ class MultiPart_Downloader:
     #   If this fails, the function aborts.
     #   
     #   Each part should put a message on inqueue with the key "need_start" (= True/False)
-    #   Once all parts have emitted this, those with (need_start = True) will receive a
-    #   start time on their inqueue.
+    #   Each run of adjacent parts with (need_start = True) will receive start times on their
+    #   inqueue once the parts on either side of it have emitted this (see start_run()).
+    #   
+    #   Similarly, once a part has emitted "need_end", the part before it (and, if it is the last
+    #   part, itself) will receive an end time if it needs one (see send_end_time()).
     #   
-    #   The same will then be done with "need_end"
+    #   If a journal from a previous download is found (and @no_resume is false), the duration,
+    #   start times and end times are taken from it instead, so all parts are started at once
+    #   and parts that were already done are not started at all.
+    #   Without a journal, any part files left by a previous download (in any number of parts) are
+    #   resumed where they are, with new parts laid out in the gaps between them (see layout_parts()),
+    #   so there may end up being more than @numparts parts.
+    #   Otherwise, if @probe_cache knows where the stream starts for each of the start times,
+    #   the parts are planned from it (see plan_from_cache()) and also started at once.
+    #   With @preflight, whatever @probe_cache doesn't know is probed first (all at once).
+    #   If a part then doesn't start where planned, the cache entry and journal are dropped, all parts
+    #   are stopped and the download starts again as if neither had been there (resuming the part files
+    #   written so far, if any).
     #
-    #   The function will abort if any one part fails.
+    #   If a part fails, it will be retried (see retry_part()) while the others carry on.
+    #   The function will abort if any one part fails and can't be retried.
+    #   With @hedge, a second copy of each of the last parts that is behind is started from its
+    #   latest keyframe; whichever copy finishes first is kept.
     #
-    #   If the download was successful, the partial files are joined into @filename (and then deleted).
+    #   The download can be stopped from another thread with cancel().
     #
-    def save_stream(self, url_fn, filename, numparts, duration = float("inf"), no_resume = False, lock = False):
+    #   If the download was successful, the partial files are joined into @filename (and then deleted)
+    #   and the digest of the joined FLV is emitted (and kept in self.digest).
+    #
+    #   Returns:        the joined FLV if @filename is None and the download was successful,
+    #                   otherwise None
+    #
+    def save_stream(self, url_fn, filename, numparts, duration = float("inf"), no_resume = False, lock = False, no_index = False,
+                    tag_types = (Tag.AUDIO, Tag.VIDEO), memory_limit = 64 * 1024 * 1024, retries = 3, retry_delay = 1.0, deadline = None,
+                    start = 0, progress_file = None, progress_interval = 0.5, probe_cache = None,
+                    preflight = False, tracer = None, hedge = False):
+        if filename is None:
+            # nothing to resume or lock in memory
+            no_resume = True
+            lock = False
+        
         if lock:
             lock_file_fd = self.lock_file(filename)
             if lock_file_fd is None:
@@ -864,121 +3853,220 @@ class MultiPart_Downloader:
         try:
             # reset thread list and inqueue
             self.threads = []
-            self.inqueue = Queue.Queue()
-            self.url_fn = url_fn
+            self.inqueue = MessageQueue(self.MESSAGE_LIMIT)
+            if callable(url_fn):
+                self.url_fn = url_fn
+                self.origins = None
+            else:
+                # the first origin identifies the stream
+                self.url_fn = url_fn[0]
+                self.origins = OriginPool(url_fn)
+            self.keyframe_index = not no_index
+            self.tag_types = tuple(sorted(tag_types) )
+            self.memory_limit = memory_limit
+            self.retries = retries
+            self.retry_delay = retry_delay
+            self.deadline = None if deadline is None else time.time() + deadline
+            self.start = start
+            self.base = 0
+            self.digest = None
+            self.parts = []
+            self.filename = filename
+            self.journal_dirty = False
+            self.cache = probe_cache
+            self.tracer = tracer
+            self.hedge = hedge
+            self.hedges = {}
+            self.hedged = set()
+            self.splicing = {}
+            self.part_times = []
+            self.replan = False
+            filesize = None
+            # in case the download has to be planned again
+            requested_duration = duration
+            # from now on, @duration is the time at which to end
+            duration += start
             
-            # start part 0 first to get duration
-            self.emit("debug", "Starting part 0", None)
-            if not self.start_part_thread(0, filename, numparts, no_resume):
-                self.emit("part-failed", 0)
-                return
+            self.trace("save-stream", numparts = numparts, clip_start = start,
+                       clip_end = None if duration == float("inf") else duration)
+            journal = None
+            part_files = []
+            if not no_resume:
+                journal = self.load_journal(filename, numparts, duration)
+                if journal is not None:
+                    self.trace("plan", source = "journal")
+                else:
+                    part_files = self.find_part_files(filename)
+            if len(part_files) > 1:
+                # resume whatever parts a previous download left, however many there were
+                numparts = max(numparts, len(part_files) )
+                self.trace("plan", source = "part-files", part_files = len(part_files) )
+                self.emit("info", "Resuming {} part files in {} parts".format(len(part_files), numparts), None)
+            self.unfinished = numparts
+            self.has_video = filename is None or flv_has_video(filename)
+            self.part_files = [filename] + ["{}.part{}".format(filename, i) for i in range(1, numparts)]
+            self.board = ProgressBoard(numparts, progress_file)
+            self.progress_interval = progress_interval
+            self.progress_time = 0
+            self.last_progress = [None] * numparts
+            
+            if journal is None and len(part_files) <= 1 and (preflight or self.cache is not None):
+                if preflight:
+                    if self.cache is None:
+                        self.cache = ProbeCache(None)
+                    probing = time.time()
+                    journal = self.preflight(numparts, duration)
+                    self.trace("preflight", None, probing, planned = journal is not None)
+                else:
+                    journal = self.plan_from_cache(numparts, duration)
+                if journal is not None:
+                    self.trace("plan", source = "probes")
+                    self.emit("debug", "Planned parts from probes", None)
+                    self.journal = journal
+                    self.save_journal(filename)
+            
+            if journal is not None:
+                # everything has already been planned; start all parts now
+                self.journal = journal
+                for i, plan in enumerate(journal["parts"]):
+                    self.part_files[i] = plan.get("file", self.part_files[i])
+                duration = journal["duration"]
+                self.base = journal["base"]
+                filesize = journal["filesize"]
+                if filesize is not None:
+                    self.emit("got-filesize", filesize)
+                self.emit("got-duration", duration - self.base / 1000.0)
+                self.emit("debug", "Starting parts 0 - {} from journal".format(numparts - 1), None)
+                for i in range(numparts):
+                    if not self.start_part_thread(i, filename, numparts, no_resume, filesize, journal["parts"][i]):
+                        self.emit("part-failed", i)
+                        return
+            else:
+                self.journal = self.new_journal(numparts)
+                # start part 0 first to get duration
+                self.emit("debug", "Starting part 0", None)
+                if not self.start_part_thread(0, filename, numparts, no_resume):
+                    self.emit("part-failed", 0)
+                    return
             
             # wait for a message with "duration" in it
-            while True:
+            while journal is None:
                 part, message, status = self.wait_for_message(self.inqueue)
-                # check for a status change; either way, we didn't get duration, so fail
+                if self.cancelled:
+                    self.stop_cancelled()
+                    return
+                # check for a status change; either way, we didn't get duration, so retry or fail
                 if status is not None:
+                    if status == Status.FAIL and self.retry_part(part, filename, numparts):
+                        continue
+                    self.emit("part-failed", part)
                     self.emit("info", "Failed to get duration. Aborting", None)
                     self.stop_all_parts()
                     return
                 
                 # check for filesize
-                filesize = message.get("filesize")
-                if filesize is not None:
+                if message.get("filesize") is not None:
+                    filesize = message["filesize"]
                     self.emit("debug", "Found filesize ({})".format(filesize), None)
                     self.emit("got-filesize", filesize)
                 
                 # check for duration; if found, we can start other threads
                 if "duration" in message:
+                    self.base = message["base"]
                     duration = min(message["duration"], duration)
+                    clip_duration = duration - self.base / 1000.0
+                    if filesize is not None and clip_duration < message["duration"]:
+                        # only part of the video is wanted
+                        filesize *= clip_duration / message["duration"]
                     self.emit("debug", "Found duration ({})".format(message["duration"]), None)
-                    self.emit("got-duration", duration)
+                    if self.base:
+                        self.emit("debug", "Starting from {}".format(self.base), None)
+                    self.emit("got-duration", clip_duration)
+                    self.trace("duration", full_duration = message["duration"], base = self.base)
+                    
+                    self.journal["duration"] = duration
+                    self.journal["base"] = self.base
+                    self.journal["filesize"] = filesize
+                    if len(part_files) > 1:
+                        self.layout_parts(filename, numparts, part_files, duration * 1000 - self.base)
+                    self.save_journal(filename)
+                    
+                    # now that we have duration, we can start all other parts
+                    self.emit("debug", "Starting parts 1 - {}".format(numparts - 1), None)
+                    for i in range(1, numparts):
+                        if not self.start_part_thread(i, filename, numparts, no_resume, filesize):
+                            self.emit("part-failed", i)
+                            return
                     break
             
-            # now that we have duration, we can start all other parts
-            self.emit("debug", "Starting parts 1 - {}".format(numparts - 1), None)
-            for i in range(1, numparts):
-                if not self.start_part_thread(i, filename, numparts, no_resume):
-                    self.emit("part-failed", i)
-                    return
-            
             # process loop, wait for messages on inqueue
-            while True:
+            self.runs = {}
+            while self.unfinished:
                 part, message, status = self.wait_for_message(self.inqueue)
-                if status is not None:
-                    # if this part failed, abort all
-                    if status == Status.FAIL:
-                        self.emit("part-failed", part)
-                        self.emit("info", "Part {} failed. Stopping all parts".format(part), None)
-                        self.stop_all_parts()
-                        return
-                    
-                    # this part is done, check if all others are done too
-                    if status == Status.SUCCESS:
-                        self.emit("part-finished", part)
-                        if all(x.done for x in self.parts):
-                            self.emit("info", "All parts finished downloading", None)
-                            break
-                
-                if "progress" in message:
-                    self.emit("progress", message["progress"], part)
-                
-                if "need_start" in message:
-                    # this part has figured out if it needs start_time
-                    # check if all other parts have too
-                    if all(i.need_start is not None for i in self.parts):
-                        # get contiguous chunks of parts that need start_time
-                        for need_start, chunk in itertools.groupby(enumerate(self.parts), lambda p: p[1].need_start):
-                            if not need_start:
-                                continue
-                            indices, chunk = list(zip(*chunk) )
-                            left = indices[0]
-                            right = indices[-1] + 1
-                            
-                            if left == 0:
-                                left_time = 0
-                            else:
-                                left_time = self.parts[left - 1].start_time
-                            
-                            if right == numparts:
-                                right_time = duration * 1000
-                            else:
-                                right_time = self.parts[right].real_offset
-                            
-                            part_duration = float(right_time - left_time) / (right - left + 1)
-                            # send a start time to each of them
-                            for index, p in enumerate(chunk):
-                                p.inqueue.put(left_time + (index + 1) * part_duration)
-                                p.need_start = False
-                
-                if "need_end" in message:
-                    # this part has figured out if it needs end_time
-                    # check if all other parts have too
-                    if all(i.need_end is not None for i in self.parts):
-                        for i in range(1, numparts):
-                            # offset of part X is end time of part X-1
-                            if self.parts[i - 1].need_end:
-                                self.parts[i - 1].inqueue.put(self.parts[i].real_offset)
-                                self.parts[i - 1].need_end = False
-                        # last part should end at most at duration
-                        self.parts[-1].inqueue.put(duration * 1000)
+                if self.cancelled:
+                    self.stop_cancelled()
+                    return
+                if not self.handle_message(part, message, status, duration):
+                    if self.replan:
+                        # without the journal and cache entry, the parts are negotiated as usual
+                        return self.save_stream(url_fn, filename, numparts, requested_duration, no_resume, False, no_index,
+                                                tag_types, memory_limit, retries, retry_delay,
+                                                None if self.deadline is None else self.deadline - time.time(),
+                                                start, progress_file, progress_interval, self.cache, False, tracer, hedge)
+                    return
+            
+            self.stop_hedges()
+            self.emit_progress(force = True)
+            self.emit("info", "All parts finished downloading", None)
+            self.trace("downloaded", rss = memory_usage(), queue_high_water = self.inqueue.high_water,
+                       coalesced = self.inqueue.total_coalesced)
+            if self.origins is not None:
+                for i in range(len(self.origins.url_fns) ):
+                    self.emit("debug", "Origin {}: {} bytes/sec, {} recent errors".format(
+                        i, self.origins.rate(i), self.origins.errors[i]), None)
+            # parts report success before their threads end; wait for them
+            for i in self.parts:
+                if i.thread is not None:
+                    i.thread.join()
+            
+            # the part files are about to be joined (and deleted), so they can't be resumed any more
+            self.remove_journal(filename)
             
             # finished downloading, start joining
             self.emit("info", "Starting to join files", None)
+            clip_duration = duration - self.base / 1000.0
+            if filename is None:
+                return self.join_memory_parts(clip_duration)
+            
             # join all files and delete partials
-            # first part is contained in @filename, others in @filename.partX
-            with open(filename, "ab") as ofile:
+            # first part is contained in @filename, others in @filename.partX (in the order laid out)
+            sizes = [os.path.getsize(self.part_files[i]) for i in range(numparts)]
+            digest = hashlib.sha1()
+            with open(filename, "r+b") as ofile:
+                # the metadata is written first, so that the digest can be worked out while joining
+                self.write_metadata(ofile, sizes, clip_duration)
+                ofile.seek(0, 0)
+                self.join_part(self.parts[0], ofile, None, digest)
                 for i in range(1, numparts):
-                    part_filename = "{}.part{}".format(filename, i)
+                    part_filename = self.part_files[i]
                     
+                    joining = time.time()
                     with open(part_filename, "rb") as partfile:
-                        shutil.copyfileobj(partfile, ofile)
+                        self.join_part(self.parts[i], partfile, ofile, digest)
+                    self.trace("join", i, joining, size = sizes[i])
                     
                     self.emit("debug", "Appended part {} : {}".format(i, part_filename), None)
                     os.remove(part_filename)
                     self.emit("debug", "Deleted part {} : {}".format(i, part_filename), None)
+            
+            self.digest = digest.hexdigest()
+            self.trace("joined", digest = self.digest)
             # finished joining - all done
             self.emit("info", "Joining done", None)
+            self.emit("got-digest", self.digest)
         finally:
+            self.cancelled = False
+            if self.cache is not None:
+                self.cache.save()
             if lock:
                 self.unlock_file(filename, lock_file_fd)
@@ -0,0 +1,439 @@
+#
+#       benchmark.py
+#
+#       Measures how much each kind of fault costs a download with Parallel_RTFLV:
+#       how long it takes to recover and how many bytes have to be downloaded again.
+#
+#       Usage: python benchmark.py [parts] [--retry-delay=secs | --hedge | --origins | --scale | --memory=jobs]
+#
+#       parts:          number of parts to split up downloading (default 1)
+#       retry-delay:    seconds to wait before retrying a failed part (default 0)
+#       hedge:          hedge the last parts if they fall behind
+#       origins:        instead, download from several origins with one of them failing or slow,
+#                       and check that the parts fail over and what is counted against each origin
+#       scale:          instead, simulate downloads in more and more parts and time
+#                       how long it takes to coordinate them
+#       memory:         instead, run this many downloads one after another (with a slow
+#                       signal handler and dropped connections) and show the memory resident after each
+#
+#       Instead of a server, a synthetic FLV stream (with a keyframe every 2 secs)
+#       is generated in memory, so the results only depend on how faults are handled.
+#
+
+import sys
+import time
+import struct
+import hashlib
+import gc
+import random
+import urlparse
+from Parallel_RTFLV import MultiPart_Downloader, Tag, Status, amf_object, amf_number, memory_usage
+from faults import Fault, FaultInjector
+
+# length of the synthetic video (in secs), seconds between keyframes and msecs between tags
+DURATION = 120
+KEYFRAME_INTERVAL = 2
+VIDEO_INTERVAL = 40
+AUDIO_INTERVAL = 25
+
+# for --scale: numbers of parts to simulate, and the fraction of them resuming a previous download
+SCALE_PARTS = [10, 100, 1000, 10000]
+SCALE_RESUMED = 0.1
+
+# for --memory: seconds the debug signal handler takes, and debug/info messages to keep queued
+MEMORY_HANDLER_DELAY = 0.002
+MEMORY_MESSAGE_LIMIT = 16
+
+#
+#   FakeInfo:
+#
+#   Stand-in for the headers of a synthetic stream
+#
+class FakeInfo:
+    def gettype(self):
+        return "video/x-flv"
+
+#
+#   SyntheticStream:
+#
+#   A synthetic real-time FLV stream, starting at the keyframe at or before @seek (in secs)
+#   like the server would. Tags are only generated as they are read.
+#
+class SyntheticStream:
+    def __init__(self, seek, duration, keyframe_interval, video_interval, audio_interval):
+        self.start = int(seek) // keyframe_interval * keyframe_interval
+        self.duration = duration
+        self.keyframe_interval = keyframe_interval
+        self.video_interval = video_interval
+        self.audio_interval = audio_interval
+        self.tags = self.generate()
+        self.buffer = ""
+    
+    def generate(self):
+        start = self.start
+        amf_name = "\x02" + struct.pack("!H", 10) + "onMetaData"
+        yield "FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00"
+        yield Tag.create(Tag.METADATA, 0, amf_name + amf_object([("duration", amf_number(self.duration) )], ecma = True) ).data
+        yield Tag.create(Tag.METADATA, 0, amf_name + amf_object([("timeBase", amf_number(start) )], ecma = True) ).data
+        yield Tag.create(Tag.AUDIO, 0, "\xaf\x00\x12\x10").data
+        yield Tag.create(Tag.VIDEO, 0, "\x17\x00\x00\x00\x00\x01").data
+        for t in range(start * 1000, self.duration * 1000, 5):
+            if t % self.video_interval == 0:
+                flags = "\x17" if t % (self.keyframe_interval * 1000) == 0 else "\x27"
+                yield Tag.create(Tag.VIDEO, t - start * 1000, flags + "\x01" + struct.pack("!I", t) * 500).data
+            if t % self.audio_interval == 0:
+                yield Tag.create(Tag.AUDIO, t - start * 1000, "\xaf\x01" + struct.pack("!I", t) * 75).data
+        # end of stream
+        for i in range(3):
+            yield Tag.create(Tag.END, 0, "\x00" * 3).data
+    
+    def read(self, size = -1):
+        while size < 0 or len(self.buffer) < size:
+            data = next(self.tags, None)
+            if data is None:
+                break
+            self.buffer += data
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+    
+    def info(self):
+        return FakeInfo()
+    
+    def close(self):
+        pass
+
+#
+#   SyntheticServer:
+#
+#   Opens synthetic streams (see #SyntheticStream) for URLs from url_fn(), in place of urllib2.urlopen
+#
+class SyntheticServer:
+    def __init__(self, duration = DURATION, keyframe_interval = KEYFRAME_INTERVAL,
+                 video_interval = VIDEO_INTERVAL, audio_interval = AUDIO_INTERVAL):
+        self.duration = duration
+        self.keyframe_interval = keyframe_interval
+        self.video_interval = video_interval
+        self.audio_interval = audio_interval
+    
+    def __call__(self, url):
+        seek = float(urlparse.parse_qs(urlparse.urlparse(url).query)["seek"][0])
+        return SyntheticStream(seek, self.duration, self.keyframe_interval, self.video_interval, self.audio_interval)
+
+def url_fn(time):
+    return "synthetic:?seek={}".format(time)
+
+#
+#   origin_url_fn:
+#   @origin:        index of origin
+#   
+#   Returns:        function to generate URLs for @origin (see #OriginRouter)
+#
+def origin_url_fn(origin):
+    return lambda time: "origin{}:?seek={}".format(origin, time)
+
+#
+#   OriginRouter:
+#
+#   Opens URLs from origin_url_fn() with the #FaultInjector for their origin, in place of urllib2.urlopen
+#
+class OriginRouter:
+    def __init__(self, injectors):
+        self.injectors = injectors
+    
+    def __call__(self, url):
+        origin = int(url.split(":", 1)[0][len("origin"):])
+        return self.injectors[origin](url)
+
+#
+#   part_tags:
+#   @parts:         number of parts
+#   
+#   Returns:        number of tags in the stream each part reads (counting the metadata tags), so that
+#                   faults can be injected at the same point in a part however many parts there are
+#
+def part_tags(parts):
+    return DURATION * (1000 // VIDEO_INTERVAL + 1000 // AUDIO_INTERVAL) // parts + 4
+
+#
+#   scenarios:
+#   @parts:         number of parts
+#   
+#   Returns:        list of (name, faults to inject into each stream opened, in order)
+#
+def scenarios(parts):
+    tags = part_tags(parts)
+    # tags from one keyframe to the next
+    keyframe_tags = KEYFRAME_INTERVAL * (1000 // VIDEO_INTERVAL + 1000 // AUDIO_INTERVAL)
+    return [
+        ("no faults", []),
+        ("drop in FLV header", [Fault(Fault.HEADER)]),
+        ("wrong MIME type", [Fault(Fault.MIME)]),
+        ("drop in tag header", [Fault(Fault.TAG_HEADER, tags // 4)]),
+        ("drop in tag body", [Fault(Fault.TAG_BODY, tags // 4)]),
+        ("drop before first keyframe", [Fault(Fault.TAG_BODY, 3)]),
+        ("drop just after keyframe", [Fault(Fault.TAG_BODY, tags // 4 - tags // 4 % keyframe_tags + 6)]),
+        ("drop, then drop in header", [Fault(Fault.TAG_BODY, tags // 4), Fault(Fault.HEADER)]),
+        ("5 drops", [Fault(Fault.TAG_BODY, tags // 8)] * 5),
+        ("trickle", [Fault(Fault.TRICKLE, delay = 0.0002)]),
+    ]
+
+#
+#   origin_scenarios:
+#   @parts:         number of parts
+#   
+#   Returns:        for --origins, list of (name, faults to inject into the streams opened
+#                   from each origin, in order)
+#
+def origin_scenarios(parts):
+    return [
+        ("3 healthy origins", [[], [], []]),
+        ("origin 1 down", [[], [Fault(Fault.HEADER)] * 1000, []]),
+        ("origin 1 wrong MIME type", [[], [Fault(Fault.MIME)] * 1000, []]),
+        ("origin 0 drops", [[Fault(Fault.TAG_BODY, part_tags(parts) // 8)] * 1000, [], []]),
+        ("origin 2 slow", [[], [], [Fault(Fault.TRICKLE, delay = 0.0005)] * 1000]),
+    ]
+
+#
+#   run:
+#   @faults:        faults to inject
+#   @parts:         number of parts
+#   @retry_delay:   seconds to wait before retrying a failed part
+#   @hedge:         whether to hedge the last parts
+#
+#   Returns:        (#FaultInjector, seconds taken, sha1 of the downloaded FLV or None)
+#
+def run(faults, parts, retry_delay, hedge = False):
+    downloader = MultiPart_Downloader()
+    injector = FaultInjector(SyntheticServer(), faults)
+    downloader.urlopen = injector
+    start = time.time()
+    result = downloader.save_stream(url_fn, None, parts, retries = 3, retry_delay = retry_delay, memory_limit = 1 << 30,
+                                   hedge = hedge)
+    taken = time.time() - start
+    if result is None:
+        return injector, taken, None
+    return injector, taken, hashlib.sha1(result.read() ).hexdigest()
+
+#
+#   run_origins:
+#   @parts:         number of parts
+#   @retry_delay:   seconds to wait before retrying a failed part
+#   @hedge:         whether to hedge the last parts
+#   
+#   Downloads from several origins in each of origin_scenarios() and prints what each origin
+#   served and what the downloader's #OriginPool counted against it. Checks that the download
+#   failed over to the working origins (the output is the same as with healthy origins),
+#   that every connection was given back to the pool and that errors were only counted
+#   against the origins that had faults.
+#   
+#   Returns:        whether every check passed
+#
+def run_origins(parts, retry_delay, hedge = False):
+    print "{:<26} {:>6} {:>6} {:>10} {:>6} {:>7} {:>10} {}".format(
+        "scenario", "origin", "opens", "bytes", "faults", "errors", "KB/sec", "check")
+    baseline = None
+    passed = True
+    for name, faults in origin_scenarios(parts):
+        downloader = MultiPart_Downloader()
+        injectors = [FaultInjector(SyntheticServer(), i) for i in faults]
+        downloader.urlopen = OriginRouter(injectors)
+        result = downloader.save_stream([origin_url_fn(i) for i in range(len(faults) )], None, parts,
+                                        retries = 3, retry_delay = retry_delay, memory_limit = 1 << 30, hedge = hedge)
+        digest = None if result is None else hashlib.sha1(result.read() ).hexdigest()
+        if baseline is None:
+            baseline = digest
+        pool = downloader.origins
+        
+        problems = []
+        if digest is None:
+            problems.append("FAILED")
+        elif digest != baseline:
+            problems.append("DIFFERENT")
+        if any(pool.active):
+            problems.append("connections not released")
+        for origin, injector in enumerate(injectors):
+            if (pool.errors[origin] > 0) != (injector.faults_injected > 0):
+                problems.append("errors of origin {}".format(origin) )
+        passed = passed and not problems
+        
+        for origin, injector in enumerate(injectors):
+            rate = pool.rate(origin)
+            print "{:<26} {:>6} {:>6} {:>10} {:>6} {:>7.2f} {:>10} {}".format(
+                name if origin == 0 else "", origin, injector.opens, injector.bytes, injector.faults_injected,
+                pool.errors[origin], "-" if rate is None else "{:.0f}".format(rate / 1024),
+                "" if origin else ", ".join(problems) or "ok")
+    return passed
+
+#
+#   SimulatedPart:
+#
+#   Stands in for a #StreamPart (without a thread) when simulating a download with run_scale().
+#   Whatever the downloader sends the part is handed to @simulation.
+#
+class SimulatedPart:
+    def __init__(self, part, simulation):
+        self.part = part
+        self.simulation = simulation
+        self.inqueue = self
+        self.start_time = None
+        self.real_offset = None
+        self.end_time = None
+        self.need_start = None
+        self.need_end = None
+        self.keyframes = {}
+        self.digest = None
+        self.done = False
+        self.hedge = False
+        self.downloading_since = None
+        self.thread = None
+    
+    def put(self, value):
+        self.simulation.append( (self.part, value) )
+
+#
+#   run_scale:
+#   @parts:         number of parts
+#   
+#   Simulates downloading a video in @parts parts: each part asks for a start time, then
+#   an end time and finishes, in a random order, with some resuming from a previous download.
+#   Only the time spent handling the messages from the parts is measured
+#   (see MultiPart_Downloader.handle_message()).
+#   
+#   Returns:        (number of messages, seconds spent handling them, longest time spent handling one)
+#
+def run_scale(parts):
+    rand = random.Random(parts)
+    duration = parts * 10
+    downloader = MultiPart_Downloader()
+    downloader.journal = downloader.new_journal(parts)
+    downloader.unfinished = parts
+    # replies from the downloader, and messages from the parts not yet handled
+    simulation = []
+    messages = []
+    downloader.parts = [SimulatedPart(i, simulation) for i in range(parts)]
+    for p in downloader.parts:
+        if p.part == 0 or rand.random() < SCALE_RESUMED:
+            p.start_time = p.real_offset = p.part * 10000 + rand.randrange(10) * 1000
+        p.need_start = p.start_time is None
+        messages.append( (p.part, dict(need_start = p.need_start), None) )
+    
+    timings = []
+    while messages:
+        # parts don't run in order
+        index = rand.randrange(len(messages) )
+        messages[index], messages[-1] = messages[-1], messages[index]
+        part, message, status = messages.pop()
+        if message.get("need_start") is False:
+            # already knows where it starts
+            downloader.parts[part].need_end = True
+            messages.append( (part, dict(need_end = True), None) )
+        
+        start = time.time()
+        downloader.handle_message(part, message, status, duration)
+        timings.append(time.time() - start)
+        
+        for part, value in simulation:
+            p = downloader.parts[part]
+            if p.start_time is None:
+                # open the stream (at the keyframe before the start time)
+                p.start_time = value
+                p.real_offset = value // 1000 * 1000
+                p.need_end = True
+                messages.append( (part, dict(need_end = True), None) )
+            else:
+                p.end_time = value
+                p.done = True
+                messages.append( (part, {}, Status.SUCCESS) )
+        del simulation[:]
+    
+    if downloader.unfinished:
+        print "{} parts: {} parts never finished".format(parts, downloader.unfinished)
+        sys.exit(1)
+    return len(timings), sum(timings), max(timings)
+
+#
+#   run_memory:
+#   @jobs:          number of downloads
+#   @parts:         number of parts
+#   
+#   Runs @jobs downloads one after another, each with 5 dropped connections and a slow handler
+#   for debug messages (so that they back up), and prints how much memory is resident after each
+#   and how the messages from the parts were queued.
+#
+def run_memory(jobs, parts):
+    print "{:>4} {:>7} {:>12} {:>11} {:>10} {}".format("job", "secs", "resident MB", "high water", "coalesced", "output")
+    baseline = None
+    for job in range(jobs):
+        downloader = MultiPart_Downloader()
+        downloader.MESSAGE_LIMIT = MEMORY_MESSAGE_LIMIT
+        downloader.urlopen = FaultInjector(SyntheticServer(), [Fault(Fault.TAG_BODY, part_tags(parts) // 8)] * 5)
+        downloader.connect("debug", lambda message, part: time.sleep(MEMORY_HANDLER_DELAY) )
+        start = time.time()
+        result = downloader.save_stream(url_fn, None, parts, retries = 5, retry_delay = 0, memory_limit = 1 << 30)
+        taken = time.time() - start
+        digest = None if result is None else hashlib.sha1(result.read() ).hexdigest()
+        if baseline is None:
+            baseline = digest
+        if digest is None:
+            output = "FAILED"
+        else:
+            output = "same" if digest == baseline else "DIFFERENT"
+        # the downloader and its output are left in reference cycles; count only what is live
+        del result
+        gc.collect()
+        memory = memory_usage()
+        print "{:>4} {:>7.3f} {:>12} {:>11} {:>10} {}".format(job, taken, "?" if memory is None else "{:.1f}".format(memory / 1048576.0),
+            downloader.inqueue.high_water, downloader.inqueue.total_coalesced, output)
+
+parts = 1
+retry_delay = 0
+hedge = False
+scale = False
+origins = False
+memory_jobs = None
+for i in sys.argv[1:]:
+    if i.startswith("--retry-delay="):
+        retry_delay = float(i.split("=", 1)[1])
+    elif i == "--hedge":
+        hedge = True
+    elif i == "--origins":
+        origins = True
+    elif i == "--scale":
+        scale = True
+    elif i.startswith("--memory="):
+        memory_jobs = int(i.split("=", 1)[1])
+    else:
+        parts = int(i)
+
+if scale:
+    print "{:>6} {:>9} {:>15} {:>15}".format("parts", "messages", "usecs/message", "max usecs")
+    for parts in SCALE_PARTS:
+        messages, handling, longest = run_scale(parts)
+        print "{:>6} {:>9} {:>15.1f} {:>15.1f}".format(parts, messages, handling / messages * 1e6, longest * 1e6)
+    sys.exit(0)
+
+if origins:
+    sys.exit(0 if run_origins(parts, retry_delay, hedge) else 1)
+
+if memory_jobs is not None:
+    run_memory(memory_jobs, parts)
+    sys.exit(0)
+
+print "{:<28} {:>7} {:>6} {:>12} {:>12} {:>13} {}".format(
+    "scenario", "secs", "opens", "bytes", "re-read", "recovery secs", "output")
+baseline = None
+for name, faults in scenarios(parts):
+    injector, taken, digest = run(faults, parts, retry_delay, hedge)
+    if baseline is None:
+        baseline = injector.bytes, digest
+    recovery = max(injector.recoveries) if injector.recoveries else 0
+    if injector.faults_injected > len(injector.recoveries):
+        recovery = float("nan")
+    if digest is None:
+        output = "FAILED"
+    else:
+        output = "same" if digest == baseline[1] else "DIFFERENT"
+    print "{:<28} {:>7.3f} {:>6} {:>12} {:>12} {:>13.4f} {}".format(
+        name, taken, injector.opens, injector.bytes, injector.bytes - baseline[0], recovery, output)
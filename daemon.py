@@ -0,0 +1,583 @@
+#
+#       daemon.py
+#
+#       Long-running download service built on Parallel_RTFLV. Jobs are added (and watched)
+#       over a Unix socket and kept in an SQLite database.
+#
+#       Usage: python daemon.py socket database [--workers=N] [--probe-cache=file]
+#              python daemon.py socket request
+#
+#       socket:         Unix socket to listen for requests on
+#       database:       SQLite database to keep jobs in
+#       workers:        number of jobs to download at once (default 2)
+#       probe-cache:    file to keep the #ProbeCache shared by all jobs in (default: only in memory)
+#       request:        instead of running the daemon, send it this request and print the reply
+#
+#       Requests are JSON objects, one per line, each answered with a line of JSON:
+#       {"ok": true, ...} or {"ok": false, "error": message}
+#
+#           {"command": "add", "url": url, "filename": filename, "parts": parts, "options": {...}}
+#                           queues a download (like example.py); replies with the "job" id.
+#                           options are passed on to MultiPart_Downloader.save_stream() (see JOB_OPTIONS)
+#           {"command": "list"}
+#                           replies with the "jobs" (without their plans)
+#           {"command": "status", "job": id, "plan": false}
+#                           replies with the "job" (with its plan, if asked for) and, if it is running,
+#                           the live progress of each of its parts and the state of its message queue
+#           {"command": "cancel", "job": id}
+#                           cancels a queued or running job (what has been downloaded is kept)
+#           {"command": "stats"}
+#                           replies with the number of jobs in each state, the jobs running,
+#                           their total rate, the number of streams in the probe cache and the
+#                           memory the daemon has resident (also logged as each job finishes)
+#
+#       e.g. python daemon.py /tmp/rtflv.sock '{"command": "add", "url": "http://...", "filename": "/videos/video.flv", "parts": 5}'
+#
+#       Each job's progress and plan (the journal, with the keyframes of the parts that are done)
+#       is saved to the database as it goes. Jobs that were running when the daemon stopped are
+#       queued again, and carry on from where they were when it starts again.
+#       All jobs share the probe cache, so downloading a stream again needs no probing.
+#
+
+import sys
+import os
+import json
+import time
+import gc
+import signal
+import socket
+import sqlite3
+import SocketServer
+from threading import Thread, Lock, Event
+from Parallel_RTFLV import MultiPart_Downloader, ProbeCache, memory_usage
+
+# options of a job that are passed on to MultiPart_Downloader.save_stream()
+JOB_OPTIONS = ("duration", "start", "no_resume", "no_index", "tag_types", "retries", "retry_delay", "deadline",
+               "preflight", "hedge")
+# seconds between saving the progress (and plan) of a running job to the database
+SAVE_INTERVAL = 5.0
+
+#
+#   JobDatabase:
+#
+#   The jobs, kept in an SQLite database. Each job has a url, filename, number of parts and options,
+#   a state (one of the states below), when it was added, started and finished and (once started)
+#   the progress of each part (see #PartProgress), the plan (see MultiPart_Downloader.load_journal()),
+#   the digest of the FLV and, if it failed, why.
+#   The connection is shared by the threads of the daemon, one at a time.
+#
+class JobDatabase:
+    # possible states of a job
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    
+    # columns kept as JSON
+    JSON_COLUMNS = ("options", "progress", "plan")
+    
+    #
+    #   __init__:
+    #   @filename:      SQLite database (created if it doesn't exist)
+    #
+    def __init__(self, filename):
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread = False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, filename TEXT NOT NULL,
+                parts INTEGER NOT NULL, options TEXT NOT NULL, state TEXT NOT NULL, added REAL NOT NULL,
+                started REAL, finished REAL, progress TEXT, plan TEXT, digest TEXT, error TEXT)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+    
+    #
+    #   job:
+    #   @row:           row of the jobs table
+    #
+    #   Returns:        the job in @row as a dictionary
+    #
+    def job(self, row):
+        job = dict(zip(row.keys(), row) )
+        for i in self.JSON_COLUMNS:
+            if job.get(i) is not None:
+                job[i] = json.loads(job[i])
+        return job
+    
+    #
+    #   add:
+    #   @url:           URL of the stream
+    #   @filename:      filename to save the FLV to
+    #   @parts:         number of parts
+    #   @options:       options for MultiPart_Downloader.save_stream()
+    #
+    #   Returns:        id of the new (queued) job, or None if a queued or running job already
+    #                   saves to @filename
+    #
+    def add(self, url, filename, parts, options):
+        with self.lock, self.db:
+            active = self.db.execute("SELECT id FROM jobs WHERE filename = ? AND state IN (?, ?)",
+                                     (filename, self.QUEUED, self.RUNNING) ).fetchone()
+            if active is not None:
+                return None
+            cursor = self.db.execute("INSERT INTO jobs (url, filename, parts, options, state, added) VALUES (?, ?, ?, ?, ?, ?)",
+                                     (url, filename, parts, json.dumps(options), self.QUEUED, time.time() ) )
+            return cursor.lastrowid
+    
+    #
+    #   get:
+    #   @job_id:        id of a job
+    #
+    #   Returns:        the job, or None if there is none with @job_id
+    #
+    def get(self, job_id):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,) ).fetchone()
+        return None if row is None else self.job(row)
+    
+    #
+    #   list:
+    #
+    #   Returns:        all jobs (without their plans), oldest first
+    #
+    def list(self):
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        jobs = [self.job(i) for i in rows]
+        for i in jobs:
+            del i["plan"]
+        return jobs
+    
+    #
+    #   counts:
+    #
+    #   Returns:        dictionary of the number of jobs in each state
+    #
+    def counts(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall() )
+    
+    #
+    #   update:
+    #   @job_id:        id of a job
+    #   @only_if:       state the job has to be in to be updated, or None
+    #   @fields:        columns to change
+    #
+    #   Returns:        True iff the job was updated
+    #
+    def update(self, job_id, only_if = None, **fields):
+        for i in self.JSON_COLUMNS:
+            if fields.get(i) is not None:
+                fields[i] = json.dumps(fields[i])
+        query = "UPDATE jobs SET " + ", ".join("{} = ?".format(i) for i in fields) + " WHERE id = ?"
+        args = fields.values() + [job_id]
+        if only_if is not None:
+            query += " AND state = ?"
+            args.append(only_if)
+        with self.lock, self.db:
+            return self.db.execute(query, args).rowcount == 1
+    
+    #
+    #   claim:
+    #
+    #   Marks the oldest queued job as running.
+    #
+    #   Returns:        the job, or None if there are no jobs queued
+    #
+    def claim(self):
+        with self.lock, self.db:
+            row = self.db.execute("SELECT * FROM jobs WHERE state = ? ORDER BY id LIMIT 1", (self.QUEUED,) ).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE jobs SET state = ?, started = ? WHERE id = ?", (self.RUNNING, time.time(), row["id"]) )
+        job = self.job(row)
+        job["state"] = self.RUNNING
+        return job
+    
+    #
+    #   requeue:
+    #
+    #   Queues the jobs left running (when the daemon last stopped) again
+    #
+    #   Returns:        number of jobs queued again
+    #
+    def requeue(self):
+        with self.lock, self.db:
+            return self.db.execute("UPDATE jobs SET state = ? WHERE state = ?", (self.QUEUED, self.RUNNING) ).rowcount
+    
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+#
+#   RequestHandler:
+#
+#   Answers each line (a JSON request) read from a connection to the daemon's socket
+#   with a line of JSON (see Daemon.request())
+#
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if not line.strip():
+                continue
+            try:
+                reply = self.server.daemon.request(json.loads(line) )
+            except ValueError as e:
+                reply = dict(ok = False, error = str(e) )
+            except KeyError as e:
+                reply = dict(ok = False, error = "Missing {}".format(e) )
+            except (TypeError, sqlite3.Error) as e:
+                # e.g. a job id of the wrong type
+                reply = dict(ok = False, error = "Bad request: {}".format(e) )
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+#
+#   Daemon:
+#
+#   Downloads the jobs in a #JobDatabase, @workers at a time, each with its own #MultiPart_Downloader
+#   (sharing a #ProbeCache), and answers requests about them (see request()).
+#
+class Daemon:
+    #
+    #   __init__:
+    #   @database:      SQLite database to keep jobs in (see #JobDatabase)
+    #   @workers:       number of jobs to download at once
+    #   @probe_cache:   file to keep the #ProbeCache in, or None
+    #
+    def __init__(self, database, workers = 2, probe_cache = None):
+        self.jobs = JobDatabase(database)
+        self.workers = workers
+        self.cache = ProbeCache(probe_cache)
+        self.lock = Lock()
+        # downloader of each running job, and the running jobs cancelled
+        self.running = {}
+        self.cancelled = set()
+        # set when jobs are added (or the daemon is stopping)
+        self.wakeup = Event()
+        self.stopping = False
+        self.threads = []
+        self.server = None
+        self.started = time.time()
+    
+    #
+    #   log:
+    #   @message:       message
+    #   @job_id:        job the message is about, or None
+    #
+    def log(self, message, job_id = None):
+        if job_id is not None:
+            message = "Job {}: {}".format(job_id, message)
+        sys.stderr.write("{} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"), message) )
+    
+    #
+    #   request:
+    #   @request:       the request (see the top of this file)
+    #
+    #   Returns:        the reply
+    #
+    def request(self, request):
+        if not isinstance(request, dict):
+            raise ValueError("Request is not an object")
+        command = request.get("command")
+        if command not in ("add", "list", "status", "cancel", "stats"):
+            raise ValueError("Unknown command: {}".format(command) )
+        reply = getattr(self, "command_" + command)(request)
+        reply["ok"] = True
+        return reply
+    
+    def command_add(self, request):
+        url = request.get("url")
+        filename = request.get("filename")
+        parts = request.get("parts", 1)
+        options = request.get("options", {})
+        if not isinstance(url, basestring) or not isinstance(filename, basestring):
+            raise ValueError("url and filename are needed")
+        if not isinstance(parts, int) or parts < 1:
+            raise ValueError("parts must be a positive number")
+        if not isinstance(options, dict):
+            raise ValueError("options must be an object")
+        for i in options:
+            if i not in JOB_OPTIONS:
+                raise ValueError("Unknown option: {}".format(i) )
+        
+        job_id = self.jobs.add(url, os.path.abspath(filename), parts, options)
+        if job_id is None:
+            raise ValueError("A job is already saving to {}".format(filename) )
+        self.log("Added {}".format(filename), job_id)
+        self.wakeup.set()
+        return dict(job = job_id)
+    
+    def command_list(self, request):
+        return dict(jobs = self.jobs.list() )
+    
+    def command_status(self, request):
+        job = self.jobs.get(request.get("job") )
+        if job is None:
+            raise ValueError("No such job: {}".format(request.get("job") ) )
+        if not request.get("plan"):
+            del job["plan"]
+        with self.lock:
+            downloader = self.running.get(job["id"])
+        if downloader is not None and downloader.board is not None:
+            job["progress"] = self.progress(downloader)
+            queue = downloader.inqueue
+            job["queue"] = dict(queued = queue.qsize(), high_water = queue.high_water, coalesced = queue.total_coalesced)
+        return dict(job = job)
+    
+    def command_cancel(self, request):
+        job_id = request.get("job")
+        if self.jobs.update(job_id, JobDatabase.QUEUED, state = JobDatabase.CANCELLED, finished = time.time() ):
+            self.log("Cancelled", job_id)
+            return {}
+        with self.lock:
+            downloader = self.running.get(job_id)
+            if downloader is None:
+                raise ValueError("Job {} is not queued or running".format(job_id) )
+            self.cancelled.add(job_id)
+        downloader.cancel()
+        self.log("Cancelling", job_id)
+        return {}
+    
+    def command_stats(self, request):
+        with self.lock:
+            running = self.running.items()
+        rate = 0
+        for job_id, downloader in running:
+            if downloader.board is not None:
+                rate += sum(i["rate"] for i in self.progress(downloader) )
+        return dict(jobs = self.jobs.counts(), running = sorted(i for i, downloader in running), rate = rate,
+                    workers = self.workers, uptime = time.time() - self.started, streams_cached = len(self.cache.entries),
+                    memory = memory_usage() )
+    
+    #
+    #   progress:
+    #   @downloader:    #MultiPart_Downloader of a running job
+    #
+    #   Returns:        list of the progress of each part (see #PartProgress), as dictionaries
+    #
+    def progress(self, downloader):
+        board = downloader.board
+        return [dict(board.get(i)._asdict() ) for i in range(board.numparts)]
+    
+    #
+    #   run_job:
+    #   @job:           job (which has been claimed; see JobDatabase.claim())
+    #
+    #   Downloads @job and records how it went in self.jobs.
+    #   If the job has been saved to the database with a plan but its journal has gone,
+    #   the journal is written back first, so the download carries on from the plan.
+    #
+    def run_job(self, job):
+        job_id = job["id"]
+        filename = job["filename"]
+        downloader = MultiPart_Downloader()
+        result = dict(done = False, digest = None, error = None, saved = time.time() )
+        
+        def got_digest(digest):
+            result["done"] = True
+            result["digest"] = digest
+        # the last info message from each part (or from the downloader, for None)
+        reasons = {}
+        def got_info(message, part):
+            reasons[part] = message
+        def got_part_failed(part):
+            # the part's last message is why it failed
+            result["error"] = "Part {} failed".format(part)
+            if part in reasons:
+                result["error"] += ": " + reasons[part]
+        def got_progress(progress, part):
+            now = time.time()
+            if now - result["saved"] >= SAVE_INTERVAL:
+                result["saved"] = now
+                self.jobs.update(job_id, progress = self.progress(downloader), plan = downloader.journal)
+        downloader.connect("got-digest", got_digest)
+        downloader.connect("info", got_info)
+        downloader.connect("part-failed", got_part_failed)
+        downloader.connect("progress", got_progress)
+        
+        with self.lock:
+            if self.stopping:
+                self.jobs.update(job_id, state = JobDatabase.QUEUED)
+                return
+            self.running[job_id] = downloader
+        journalname = filename + ".journal"
+        if job["plan"] is not None and not os.path.exists(journalname):
+            try:
+                with open(journalname, "wb") as f:
+                    json.dump(job["plan"], f)
+            except IOError as e:
+                self.log("Could not restore journal: {}".format(e), job_id)
+        
+        options = dict( (str(k), v) for k, v in job["options"].items() )
+        if "tag_types" in options:
+            options["tag_types"] = tuple(options["tag_types"])
+        url = job["url"]
+        def url_fn(time):
+            return "{}&seek={}".format(url, time)
+        
+        self.log("Starting {} in {} parts".format(filename, job["parts"]), job_id)
+        try:
+            downloader.save_stream(url_fn, filename, job["parts"], probe_cache = self.cache, **options)
+        except Exception as e:
+            result["error"] = "{}: {}".format(type(e).__name__, e)
+        finally:
+            with self.lock:
+                del self.running[job_id]
+                cancelled = job_id in self.cancelled
+                self.cancelled.discard(job_id)
+        
+        progress = None if downloader.board is None else self.progress(downloader)
+        if result["done"]:
+            state = JobDatabase.DONE
+        elif cancelled:
+            state = JobDatabase.CANCELLED
+        elif self.stopping:
+            # carry on when the daemon starts again
+            state = JobDatabase.QUEUED
+        else:
+            state = JobDatabase.FAILED
+            if result["error"] is None:
+                # stopped before any part was started (e.g. locked by another download)
+                result["error"] = reasons.get(None)
+        self.jobs.update(job_id, state = state, finished = None if state == JobDatabase.QUEUED else time.time(),
+                         progress = progress, plan = None if result["done"] else downloader.journal,
+                         digest = result["digest"], error = None if result["done"] else result["error"])
+        # a finished downloader is left in reference cycles, holding its output until collected
+        gc.collect()
+        memory = memory_usage()
+        self.log("{} {} ({} MB resident)".format(state.capitalize(), filename,
+                 "?" if memory is None else "{:.1f}".format(memory / 1048576.0) ), job_id)
+    
+    #
+    #   work:
+    #
+    #   Runs queued jobs, one at a time, until the daemon stops
+    #
+    def work(self):
+        while not self.stopping:
+            job = self.jobs.claim()
+            if job is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+            self.run_job(job)
+    
+    #
+    #   serve:
+    #   @path:          Unix socket to listen for requests on
+    #
+    #   Starts the workers and answers requests until stop() is called (or the process is interrupted)
+    #
+    def serve(self, path):
+        requeued = self.jobs.requeue()
+        if requeued:
+            self.log("Queued {} interrupted jobs again".format(requeued) )
+        if os.path.exists(path):
+            # left by a daemon that didn't stop cleanly (unless one is still listening)
+            s = socket.socket(socket.AF_UNIX)
+            try:
+                s.connect(path)
+            except socket.error:
+                os.remove(path)
+            else:
+                s.close()
+                raise ValueError("A daemon is already listening on " + path)
+        
+        self.server = UnixServer(path, RequestHandler)
+        self.server.daemon = self
+        for i in range(self.workers):
+            thread = Thread(target = self.work)
+            thread.start()
+            self.threads.append(thread)
+        self.log("Listening on {} with {} workers".format(path, self.workers) )
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(path)
+            self.stop()
+    
+    #
+    #   stop:
+    #
+    #   Cancels the running jobs (so they are queued again) and waits for the workers to finish
+    #
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            running = self.running.values()
+        self.wakeup.set()
+        for i in running:
+            i.cancel()
+        for i in self.threads:
+            i.join()
+        self.cache.save()
+        self.jobs.close()
+        self.log("Stopped")
+
+#
+#   send_request:
+#   @path:          Unix socket a daemon is listening on
+#   @request:       the request
+#
+#   Returns:        the reply
+#
+def send_request(path, request):
+    s = socket.socket(socket.AF_UNIX)
+    s.connect(path)
+    f = s.makefile("r+b")
+    try:
+        f.write(json.dumps(request) + "\n")
+        f.flush()
+        return json.loads(f.readline() )
+    finally:
+        f.close()
+        s.close()
+
+#
+#   terminate:
+#
+#   Stops the daemon cleanly (see Daemon.serve()) when it is killed
+#
+def terminate(signum, frame):
+    sys.exit(0)
+
+#
+#   main:
+#
+#   Runs the daemon, or sends it a request, as given on the command line (see above)
+#
+def main():
+    if len(sys.argv) < 3:
+        print "Usage: python {} socket database [--workers=N] [--probe-cache=file]".format(sys.argv[0])
+        print "       python {} socket request".format(sys.argv[0])
+        sys.exit(0)
+    
+    path = sys.argv[1]
+    if sys.argv[2].startswith("{"):
+        reply = send_request(path, json.loads(sys.argv[2]) )
+        print json.dumps(reply, indent = 2, sort_keys = True)
+        sys.exit(0 if reply["ok"] else 1)
+    
+    workers = 2
+    probe_cache = None
+    for i in sys.argv[3:]:
+        if i.startswith("--workers="):
+            workers = int(i.split("=", 1)[1])
+        elif i.startswith("--probe-cache="):
+            probe_cache = i.split("=", 1)[1]
+    
+    signal.signal(signal.SIGTERM, terminate)
+    
+    try:
+        Daemon(sys.argv[2], workers, probe_cache).serve(path)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
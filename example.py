@@ -4,7 +4,7 @@
 #       Example command line program making use of
 #       Parallel_RTFLV
 #       
-#       Usage: python example.py url outfile parts [--debug | --no-resume | --lock]
+#       Usage: python example.py url outfile parts [--debug | --no-resume | --lock | --no-index | --audio-only | --video-only | --preflight | --hedge | --trace=name]
 #       
 #       url:            url of FLV stream - where seeking is done
 #                       by appending &seek=123
@@ -13,15 +13,21 @@
 #       debug:          debug messages will be printed
 #       no-resume:      do not attempt to resume
 #       lock:           make exclusive lock to outfile
+#       no-index:       do not write a keyframe index into outfile
+#       audio-only:     only save the audio
+#       video-only:     only save the video
+#       preflight:      find where each part starts before downloading
+#       hedge:          race a second copy of the last parts if they fall behind
+#       trace:          record what each part does in name.jsonl (and name.json for chrome://tracing)
 #
-#       If any one part fails, everything stops
+#       If a part keeps failing (after retries), everything stops
 #
 
 import sys
-from Parallel_RTFLV import MultiPart_Downloader
+from Parallel_RTFLV import MultiPart_Downloader, Tag, Tracer
 
 if len(sys.argv) < 4:
-    print "Usage: python {} url outfile parts [--debug | --no-resume | --lock]".format(sys.argv[0])
+    print "Usage: python {} url outfile parts [--debug | --no-resume | --lock | --no-index | --audio-only | --video-only | --preflight | --hedge | --trace=name]".format(sys.argv[0])
     sys.exit(0)
 
 url, outfile, parts = sys.argv[1:4]
@@ -30,6 +36,18 @@ parts = int(parts)
 debug = ("--debug" in sys.argv[4:])
 no_resume = ("--no-resume" in sys.argv[4:])
 lock = ("--lock" in sys.argv[4:])
+no_index = ("--no-index" in sys.argv[4:])
+preflight = ("--preflight" in sys.argv[4:])
+hedge = ("--hedge" in sys.argv[4:])
+trace = None
+for i in sys.argv[4:]:
+    if i.startswith("--trace="):
+        trace = i.split("=", 1)[1]
+tag_types = (Tag.AUDIO, Tag.VIDEO)
+if "--audio-only" in sys.argv[4:]:
+    tag_types = (Tag.AUDIO,)
+elif "--video-only" in sys.argv[4:]:
+    tag_types = (Tag.VIDEO,)
 
 # function to make url
 def url_fn(time):
@@ -45,8 +63,11 @@ stat_printed = False
 #       @stat:          status/progress of @part
 #       
 #       Sets progress/stats for @part in stat_strs
+#       (there may be more parts than asked for, when resuming part files)
 #
 def set_stats(part, stat):
+    while len(stat_strs) <= part:
+        stat_strs.append("{0:<6}".format(0) )
     stat_strs[part] = "{0:<6}".format(stat)
 
 # set initial progress to 0 for all parts
@@ -64,14 +85,15 @@ def print_non_stat(*output):
 #
 #       print_stats:
 #       
-#       Prints progress/stats for each part
+#       Prints progress/stats for each part (and the total download rate)
 #
 def print_stats():
     global stat_printed
     # print out the stats
     if not stat_printed:
-        print " ".join("P{0:<5}".format(i) for i in range(parts) )
-    print "\r" + " ".join(stat_strs),
+        print " ".join("P{0:<5}".format(i) for i in range(len(stat_strs) ) )
+    rate = sum(downloader.board.get(i).rate for i in range(downloader.board.numparts) )
+    print "\r" + " ".join(stat_strs), "{:>8.1f} KB/s".format(rate / 1024),
     sys.stdout.flush()
     stat_printed = True
 
@@ -82,6 +104,9 @@ def got_filesize(filesize):
 def got_duration(duration):
     print_non_stat("Duration:", duration)
 
+def got_digest(digest):
+    print "Digest:", digest
+
 def part_finished(part):
     set_stats(part, "Done")
     print_stats()
@@ -124,7 +149,18 @@ else:
 
 downloader.connect("progress", print_progress)
 downloader.connect("info", got_debug_message)
+downloader.connect("got-digest", got_digest)
+
+tracer = None
+if trace is not None:
+    tracer = Tracer(trace + ".jsonl")
 
 # download the video
 print "Saving {}\nto {}".format(url, outfile)
-downloader.save_stream(url_fn, outfile, parts, no_resume = no_resume, lock = lock)
+try:
+    downloader.save_stream(url_fn, outfile, parts, no_resume = no_resume, lock = lock, no_index = no_index, tag_types = tag_types,
+                           preflight = preflight, tracer = tracer, hedge = hedge)
+finally:
+    if tracer is not None:
+        tracer.close()
+        tracer.save_chrome_trace(trace + ".json")
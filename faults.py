@@ -0,0 +1,204 @@
+#
+#       faults:
+#
+#       Deterministic fault injection for Parallel_RTFLV.
+#
+#       A #FaultInjector is used in place of urllib2.urlopen (see MultiPart_Downloader.urlopen).
+#       It wraps each stream opened in a #FaultyStream which, following a fixed schedule,
+#       drops the connection at a chosen point in the FLV, trickles it slowly or pretends
+#       it has the wrong MIME type. It also measures how much data was read and how long
+#       it took to recover from each fault.
+#
+
+import time
+import struct
+from threading import Lock, current_thread
+
+#
+#   Fault:
+#
+#   A fault to inject into a stream.
+#
+class Fault:
+    # possible kinds of faults
+    # drop the connection in the middle of the FLV header
+    HEADER = "header"
+    # drop the connection in the middle of the 11-byte header of a tag
+    TAG_HEADER = "tag-header"
+    # drop the connection in the middle of the body of a tag
+    TAG_BODY = "tag-body"
+    # wait before every tag (and don't drop the connection)
+    TRICKLE = "trickle"
+    # report a MIME type other than video/x-flv
+    MIME = "mime"
+    
+    #
+    #   __init__:
+    #   @kind:          kind of fault
+    #   @tag:           index of the tag (counting the metadata tags) to drop the connection in
+    #   @delay:         seconds to wait before every tag (for TRICKLE)
+    #
+    def __init__(self, kind, tag = 0, delay = 0):
+        self.kind = kind
+        self.tag = tag
+        self.delay = delay
+    
+    def __repr__(self):
+        return "Fault({!r}, tag = {}, delay = {})".format(self.kind, self.tag, self.delay)
+
+#
+#   MimeInfo:
+#
+#   Stand-in for the headers of a stream, with the wrong MIME type
+#
+class MimeInfo:
+    def gettype(self):
+        return "text/html"
+
+#
+#   FaultyStream:
+#
+#   Wraps a stream and injects @fault into it. The stream is read a whole tag at a time
+#   (so that faults can be injected at the right point in a tag) and handed out from a buffer.
+#
+class FaultyStream:
+    #
+    #   __init__:
+    #   @stream:        stream to wrap
+    #   @fault:         #Fault to inject, or None
+    #   @injector:      #FaultInjector to report to
+    #
+    def __init__(self, stream, fault, injector):
+        self.stream = stream
+        self.fault = fault
+        self.injector = injector
+        self.buffer = ""
+        self.header_read = False
+        # number of tags read so far
+        self.tags = 0
+        # whether the end of the stream (or a dropped connection) has been reached
+        self.eof = False
+    
+    #
+    #   drop:
+    #   @data:          data to hand out before the connection is dropped
+    #
+    def drop(self, data):
+        self.buffer += data
+        self.eof = True
+        self.injector.dropped()
+    
+    #
+    #   fill:
+    #
+    #   Reads the FLV header or the next tag into self.buffer, injecting self.fault
+    #
+    def fill(self):
+        kind = self.fault.kind if self.fault is not None else None
+        if not self.header_read:
+            self.header_read = True
+            header = self.stream.read(13)
+            if kind == Fault.HEADER:
+                self.drop(header[:len(header) // 2])
+                return
+            self.buffer += header
+            if len(header) != 13:
+                self.eof = True
+            return
+        
+        header = self.stream.read(11)
+        if len(header) != 11:
+            self.buffer += header
+            self.eof = True
+            return
+        size = struct.unpack("!I", "\x00" + header[1:4])[0]
+        index = self.tags
+        self.tags += 1
+        if kind == Fault.TAG_HEADER and index == self.fault.tag:
+            self.drop(header[:5])
+            return
+        body = self.stream.read(size + 4)
+        if kind == Fault.TAG_BODY and index == self.fault.tag:
+            self.drop(header + body[:size // 2])
+            return
+        if kind == Fault.TRICKLE:
+            time.sleep(self.fault.delay)
+        self.buffer += header + body
+        if len(body) != size + 4:
+            self.eof = True
+        if self.tags == 3:
+            # past the metadata and first tag; data is flowing again
+            self.injector.recovered()
+    
+    def read(self, size = -1):
+        while (size < 0 or len(self.buffer) < size) and not self.eof:
+            self.fill()
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.injector.count(len(data) )
+        return data
+    
+    def info(self):
+        if self.fault is not None and self.fault.kind == Fault.MIME:
+            self.injector.dropped()
+            return MimeInfo()
+        return self.stream.info()
+    
+    def close(self):
+        self.stream.close()
+
+#
+#   FaultInjector:
+#
+#   Opens URLs (with @urlopen) and injects the faults in @faults (a list of #Fault or None)
+#   into the streams, in the order they are opened. Streams opened after that are left alone.
+#
+#   A fault is recovered from once data flows again on a stream read by the same thread (or one
+#   with the same name: Parallel_RTFLV names each part's thread after the part, so a part that
+#   is retried in a new thread is still recognised), so that one part recovering doesn't count
+#   for the faults of another.
+#
+#   Measures:
+#       opens:              number of streams opened
+#       bytes:              bytes read from all streams
+#       faults_injected:    number of faults that dropped (or broke) a stream
+#       recoveries:         seconds between each of those faults and data flowing again
+#
+class FaultInjector:
+    #
+    #   __init__:
+    #   @urlopen:       function to open URLs with
+    #   @faults:        list of #Fault (or None) to inject
+    #
+    def __init__(self, urlopen, faults):
+        self.urlopen = urlopen
+        self.faults = list(faults)
+        self.lock = Lock()
+        self.opens = 0
+        self.bytes = 0
+        self.faults_injected = 0
+        self.recoveries = []
+        # time of the faults not recovered from yet, for each thread name
+        self.pending = {}
+    
+    def __call__(self, url):
+        stream = self.urlopen(url)
+        with self.lock:
+            fault = self.faults[self.opens] if self.opens < len(self.faults) else None
+            self.opens += 1
+        return FaultyStream(stream, fault, self)
+    
+    def count(self, _bytes):
+        with self.lock:
+            self.bytes += _bytes
+    
+    def dropped(self):
+        with self.lock:
+            self.faults_injected += 1
+            self.pending.setdefault(current_thread().name, []).append(time.time() )
+    
+    def recovered(self):
+        with self.lock:
+            now = time.time()
+            self.recoveries += [now - i for i in self.pending.pop(current_thread().name, [])]
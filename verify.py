@@ -0,0 +1,40 @@
+#
+#       verify.py
+#
+#       Command line program to check FLV files (or their parts) for corruption
+#       with Parallel_RTFLV
+#
+#       Usage: python verify.py file [file ...] [--max-gap=msecs]
+#
+#       file:           FLV file, or a part file (e.g. video.flv.part2)
+#       max-gap:        largest allowed jump between timestamps (default 1000)
+#
+#       Files are checked in parallel. Part files of the same download (e.g. video.flv and
+#       video.flv.part2) are also checked for gaps and overlaps between them.
+#       Exits with 1 if any problems were found.
+#
+
+import sys
+from Parallel_RTFLV import verify_files
+
+filenames = [i for i in sys.argv[1:] if not i.startswith("--")]
+if not filenames:
+    print "Usage: python {} file [file ...] [--max-gap=msecs]".format(sys.argv[0])
+    sys.exit(0)
+
+max_gap = 1000
+for i in sys.argv[1:]:
+    if i.startswith("--max-gap="):
+        max_gap = int(i.split("=", 1)[1])
+
+failed = False
+for filename, problems in verify_files(filenames, max_gap):
+    if not problems:
+        print "{}: OK".format(filename)
+        continue
+    failed = True
+    print "{}: {} problems".format(filename, len(problems) )
+    for problem in problems:
+        print "    at {} (timestamp {}): {}".format(problem.position, problem.timestamp, problem.message)
+
+sys.exit(1 if failed else 0)